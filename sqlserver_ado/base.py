@@ -1,20 +1,48 @@
 """Microsoft SQL Server database backend for Django."""
+from django.db import transaction
 from django.db.backends import BaseDatabaseWrapper, BaseDatabaseFeatures, BaseDatabaseValidation, BaseDatabaseClient
 from django.db.backends.signals import connection_created
 from django.core.exceptions import ImproperlyConfigured
+import re
 
 import dbapi as Database
 
 from introspection import DatabaseIntrospection
 from creation import DatabaseCreation
 from operations import DatabaseOperations
+from querycache import QueryTemplateCache
 
 DatabaseError = Database.DatabaseError
 IntegrityError = Database.IntegrityError
 
+# The SET IDENTITY_INSERT statements of a batch, see DatabaseWrapper.identity_insert_sql().
+_re_identity_insert = re.compile(r'SET IDENTITY_INSERT (.+?) (ON|OFF)(?=;|$)')
+
+
+class Cursor(Database.Cursor):
+    """
+    A cursor that records the IDENTITY_INSERT state of the session once a
+    statement that changes it has run.
+    """
+    def __init__(self, connection, wrapper):
+        super(Cursor, self).__init__(connection)
+        self.wrapper = wrapper
+
+    def execute(self, operation, parameters=None):
+        if 'IDENTITY_INSERT' not in operation:
+            return super(Cursor, self).execute(operation, parameters)
+        try:
+            result = super(Cursor, self).execute(operation, parameters)
+        except:
+            self.wrapper._identity_insert_executed(operation, False)
+            raise
+        self.wrapper._identity_insert_executed(operation, True)
+        return result
+
 
 class DatabaseFeatures(BaseDatabaseFeatures):
     uses_custom_query_class = True
+    can_return_id_from_insert = True
 
 # IP Address recognizer taken from:
 # http://mail.python.org/pipermail/python-list/2006-March/375505.html
@@ -139,6 +167,31 @@ class DatabaseWrapper(BaseDatabaseWrapper):
         
         self.ops.is_sql2005 = self.is_sql2005
         self.ops.is_sql2008 = self.is_sql2008
+        self.ops.server_version = self.server_version
+
+        # django < 1.4 does not give the operations a reference to the
+        # connection, which is needed by the backend specific APIs.
+        self.ops.connection = self
+
+        options = self.settings_dict.get('OPTIONS', {})
+        if 'large_in_threshold' in options:
+            self.ops.large_in_threshold = options['large_in_threshold']
+        if 'large_in_strategy' in options:
+            if options['large_in_strategy'] not in ('xml', 'delimited'):
+                raise ImproperlyConfigured("large_in_strategy must be 'xml' or 'delimited'.")
+            self.ops.large_in_strategy = options['large_in_strategy']
+
+        # Opt-in cache of compiled SELECT statements, see QueryTemplateCache.
+        self.query_cache = None
+        cache_size = self.settings_dict.get('OPTIONS', {}).get('query_template_cache')
+        if cache_size:
+            if cache_size is True:
+                cache_size = None
+            self.query_cache = QueryTemplateCache(cache_size)
+
+        # The quoted name of the table that has IDENTITY_INSERT on in this
+        # session, see identity_insert_sql().
+        self.identity_insert_table = None
 
     def __connect(self):
         """Connect to the database"""
@@ -167,7 +220,74 @@ class DatabaseWrapper(BaseDatabaseWrapper):
             self.__connect()
         return self.connection.is_sql2008        
 
+    def server_version(self):
+        """
+        Returns the major version of the server, e.g. 10 for SQL Server
+        2008. Establishes a connection if needed.
+        """
+        if not self.connection:
+            self.__connect()
+        return self.connection.server_version
+
+    def identity_insert_sql(self, table, explicit_id):
+        """
+        Returns a tuple of the SQL to run before and after an insert into
+        the given quoted table, with (`explicit_id`) or without explicit
+        values for its IDENTITY column. The cursor records the new
+        IDENTITY_INSERT state of the session when the statements have run.
+
+        Within a managed transaction, IDENTITY_INSERT is turned on once and
+        left on for further inserts into the same table, so loading a
+        fixture costs one statement per row. It is turned off when another
+        table needs it (only one table per session can have it on), before
+        an insert into the table without an explicit id, and on commit and
+        rollback. Outside of a managed transaction it is turned off again
+        after each insert.
+        """
+        before, after = [], []
+        current = self.identity_insert_table
+        if explicit_id:
+            if current != table:
+                if current:
+                    before.append('SET IDENTITY_INSERT %s OFF' % current)
+                before.append('SET IDENTITY_INSERT %s ON' % table)
+            if not transaction.is_managed(using=self.alias):
+                after.append('SET IDENTITY_INSERT %s OFF' % table)
+        elif current == table:
+            before.append('SET IDENTITY_INSERT %s OFF' % table)
+        return ';'.join(before), ';'.join(after)
+
+    def _identity_insert_executed(self, sql, succeeded):
+        """
+        Record the IDENTITY_INSERT state of the session after running sql.
+        If the statement failed, a table it turned on is assumed to still be
+        on, since turning it off again later is harmless.
+        """
+        for table, state in _re_identity_insert.findall(sql):
+            if state == 'ON':
+                self.identity_insert_table = table
+            elif succeeded and self.identity_insert_table == table:
+                self.identity_insert_table = None
+
+    def _reset_identity_insert(self):
+        """Turn IDENTITY_INSERT off for the table that has it on."""
+        table, self.identity_insert_table = self.identity_insert_table, None
+        if table and self.connection is not None:
+            Database.Cursor(self.connection).execute('SET IDENTITY_INSERT %s OFF' % table)
+
+    def _commit(self):
+        self._reset_identity_insert()
+        return super(DatabaseWrapper, self)._commit()
+
+    def _rollback(self):
+        self._reset_identity_insert()
+        return super(DatabaseWrapper, self)._rollback()
+
+    def close(self):
+        self.identity_insert_table = None
+        super(DatabaseWrapper, self).close()
+
     def _cursor(self):
         if self.connection is None:
             self.__connect()
-        return Database.Cursor(self.connection)
+        return Cursor(self.connection, self)
@@ -1,6 +1,8 @@
 from django.db.models.sql import compiler
 import re
 
+from where import rewrite_where
+
 # query_class returns the base class to use for Django queries.
 # The custom 'SqlServerQuery' class derives from django.db.models.sql.query.Query
 # which is passed in as "QueryClass" by Django itself.
@@ -28,6 +30,18 @@ _re_pat_col_parts = re.compile(
 # Pattern used in column aliasing to find sub-select placeholders
 _re_col_placeholder = re.compile(r'\{_placeholder_(\d+)\}')
 
+# Pattern to find the select list of an existence check built by Query.has_results()
+_re_exists_select = re.compile(r'(?i)^SELECT\s+(?:DISTINCT\s+)?\(1\) AS \[a\]')
+
+# Pattern to find the OPTION clause added for the query hints of a query
+_re_query_hints = re.compile(r' OPTION \([A-Z0-9 ,]+\)$')
+
+# Pattern to find a leading DISTINCT of a select list
+_re_distinct = re.compile(r'(?i)^DISTINCT\s+')
+
+# Pattern to find the start of the select list, after any DISTINCT or TOP
+_re_select_prefix = re.compile(r'(?i)^SELECT(?:\s+DISTINCT)?(?:\s+TOP \d+)?')
+
 def _break(s, find):
     """Break a string s into the part before the substring to find, 
     and the part including and after the substring."""
@@ -42,20 +56,174 @@ def _remove_order_limit_offset(sql):
 
 
 class SQLCompiler(compiler.SQLCompiler):
+    # Expressions that replace the select list, see
+    # DatabaseOperations.json_chunks(). With keep_columns the columns of the
+    # query follow them, e.g. for the ordering of a DISTINCT query.
+    select_list = None
+    keep_columns = False
+
+    def _with_rewritten_where(self, as_sql, *args):
+        """
+        Call as_sql with the where tree of the query replaced by a copy with
+        the lookups that would prevent index seeks rewritten (see where.py).
+        The tree of the query is restored afterwards.
+        """
+        where = self.query.where
+        self.query.where = rewrite_where(where, self.connection)
+        try:
+            return as_sql(*args)
+        finally:
+            self.query.where = where
+
     def resolve_columns(self, row, fields=()):
         # If the results are sliced, the resultset will have an initial 
         # "row number" column. Remove this column before the ORM sees it.
         if getattr(self, '_using_row_number', False):
-            return row[1:]
+            row = row[1:]
+        # The total row count requested with "with_total_count" follows.
+        if getattr(self, '_using_total_count', False):
+            self.query.total_count = row[0]
+            row = row[1:]
         return row
 
+    def get_columns(self, with_aliases=False):
+        columns = super(SQLCompiler, self).get_columns(with_aliases)
+        if self.select_list is None:
+            return columns
+        if self.keep_columns:
+            return list(self.select_list) + columns
+        return list(self.select_list)
+
+    def get_grouping(self):
+        grouping, params = super(SQLCompiler, self).get_grouping()
+        # The constant selected by an existence check is added to the GROUP BY
+        # by django, but SQL Server rejects constant grouping expressions.
+        if getattr(self, '_using_exists', False) and '(1)' in grouping:
+            grouping.remove('(1)')
+        return grouping, params
+
+    def get_table_hints(self):
+        """
+        Return a dictionary of {alias: [hint, ...]} with the table hints
+        for the tables of the FROM clause.
+        """
+        hints = {}
+        table_hints = dict(getattr(self.query, 'table_hints', None) or ())
+        if table_hints:
+            for alias in self.query.tables:
+                if alias in self.query.alias_map:
+                    name = self.query.alias_map[alias][0]
+                    hints[alias] = list(table_hints.get(name, ()))
+        if getattr(self.query, 'select_for_update', False):
+            # Take update locks while reading, so that a concurrent
+            # read-modify-write waits here instead of deadlocking when both
+            # try to convert their shared locks.
+            lock = ['UPDLOCK', 'ROWLOCK']
+            if getattr(self.query, 'select_for_update_skip_locked', False):
+                lock.append('READPAST')
+            elif getattr(self.query, 'select_for_update_nowait', False):
+                lock.append('NOWAIT')
+            for alias in self.query.tables:
+                hints.setdefault(alias, []).extend(lock)
+        return hints
+
+    def get_from_clause(self):
+        result, params = super(SQLCompiler, self).get_from_clause()
+        hints = self.get_table_hints()
+        table_sample = getattr(self.query, 'table_sample', None)
+        if hints or table_sample:
+            # Add the sample and hints after the table name and alias of each
+            # entry, which are in the order of the tables of the query.
+            qn = self.quote_name_unless_alias
+            i = 0
+            for alias in self.query.tables:
+                if not self.query.alias_refcount[alias] or alias not in self.query.alias_map:
+                    continue
+                name = self.query.alias_map[alias][0]
+                table_sql = qn(name) + (alias != name and ' %s' % alias or '')
+                suffix = ''
+                if table_sample and i == 0:
+                    percent, seed = table_sample
+                    suffix += ' TABLESAMPLE SYSTEM (%r PERCENT)' % float(percent)
+                    if seed is not None:
+                        suffix += ' REPEATABLE (%d)' % seed
+                if hints.get(alias):
+                    suffix += ' WITH (%s)' % ', '.join(hints[alias])
+                if suffix:
+                    result[i] = result[i].replace(table_sql, table_sql + suffix, 1)
+                i += 1
+        # Ranked full-text searches join the base table to CONTAINSTABLE or
+        # FREETEXTTABLE, see SqlServerQuerySet.ranked_search().
+        fulltext_rank = getattr(self.query, 'fulltext_rank', None)
+        if fulltext_rank:
+            columns, terms, freetext, top_n = fulltext_rank
+            qn = self.quote_name_unless_alias
+            qn2 = self.connection.ops.quote_name
+            opts = self.query.model._meta
+            function = freetext and 'FREETEXTTABLE' or 'CONTAINSTABLE'
+            if columns == '*':
+                column_sql = '*'
+            else:
+                column_sql = '(%s)' % ', '.join([qn2(c) for c in columns])
+            top_sql = top_n and ', %d' % top_n or ''
+            result.append('INNER JOIN %s(%s, %s, %%s%s) AS [ft_rank] ON [ft_rank].[KEY] = %s.%s' % (
+                function, qn2(opts.db_table), column_sql, top_sql,
+                qn(self.query.tables[0]), qn2(opts.pk.column)))
+            params.append(terms)
+        return result, params
+
+    def _add_total_count(self, sql):
+        """Inject a COUNT(*) OVER() column at the start of the select list."""
+        if not self._using_total_count:
+            return sql
+        return _re_select_prefix.sub(
+            lambda m: '%s COUNT(*) OVER() AS _total_count,' % m.group(0), sql, 1)
+
+    # Compiler attributes set by _as_sql() that are needed to read the results.
+    template_state = ('_using_row_number', '_using_total_count', '_using_exists')
+
     def as_sql(self, with_limits=True, with_col_aliases=False):
+        # Plain SELECT queries can be served from the compiled query template
+        # cache, if it is enabled for the connection.
+        cache = getattr(self.connection, 'query_cache', None)
+        if cache is not None and self.__class__ is SQLCompiler and self.select_list is None:
+            sql, params = self._with_rewritten_where(cache.as_sql, self, with_limits, with_col_aliases)
+        else:
+            sql, params = self._with_rewritten_where(self._as_sql, with_limits, with_col_aliases)
+        return self._add_query_hints(sql), params
+
+    def _add_query_hints(self, sql):
+        """Append the OPTION clause for the query hints of the query."""
+        query_hints = getattr(self.query, 'query_hints', None)
+        if not query_hints or not sql:
+            return sql
+        return '%s OPTION (%s)' % (sql, ', '.join(query_hints))
+
+    def as_nested_sql(self):
+        # An OPTION clause is only allowed at the end of the statement.
+        sql, params = super(SQLCompiler, self).as_nested_sql()
+        return _re_query_hints.sub('', sql), params
+
+    def _as_sql(self, with_limits=True, with_col_aliases=False):
         self._using_row_number = False
+        self._using_exists = False
+
+        # Paginators can ask for the count of all matching rows to be returned
+        # with each row, so the page and the total come back in a single query.
+        # The window count is taken before DISTINCT, so it is not used then.
+        self._using_total_count = getattr(self.query, 'with_total_count', False) \
+            and not self.query.distinct
+
+        if with_limits and self._is_existence_check():
+            self._using_total_count = False
+            self._using_exists = True
+            return self._as_exists_sql()
         
         # Get out of the way if we're not a select query or there's no limiting involved.
         check_limits = with_limits and (self.query.low_mark or self.query.high_mark is not None)
         if not check_limits:
-            return super(SQLCompiler, self).as_sql(with_limits, with_col_aliases)
+            sql, fields = super(SQLCompiler, self).as_sql(with_limits, with_col_aliases)
+            return self._add_total_count(sql), fields
 
         raw_sql, fields = super(SQLCompiler, self).as_sql(False, with_col_aliases)
         
@@ -66,7 +234,7 @@ class SQLCompiler(compiler.SQLCompiler):
                 _select += ' DISTINCT'
             
             sql = re.sub(r'(?i)^%s' % _select, '%s TOP %s' % (_select, self.query.high_mark), raw_sql, 1)
-            return sql, fields
+            return self._add_total_count(sql), fields
             
         # Else we have limits; rewrite the query using ROW_NUMBER()
         self._using_row_number = True
@@ -97,8 +265,13 @@ class SQLCompiler(compiler.SQLCompiler):
         if self.query.high_mark:
             where_row_num += " and _row_num <= %s" % (self.query.high_mark)
             
-        # Lop off ORDER... and the initial "SELECT"
+        # Lop off ORDER... and the initial "SELECT". DISTINCT goes back on the
+        # innermost select, so duplicates are removed before rows are numbered.
         inner_select = _remove_order_limit_offset(raw_sql)
+        distinct = ''
+        if self.query.distinct:
+            distinct = 'DISTINCT '
+            inner_select = _re_distinct.sub('', inner_select, 1)
         outer_fields, inner_select = self._alias_columns(inner_select)
 
         # map a copy of outer_fields for injected subselect
@@ -115,14 +288,44 @@ class SQLCompiler(compiler.SQLCompiler):
         
         
         # inject a subselect to get around OVER requiring ORDER BY to come from FROM
-        inner_select = '%s FROM ( SELECT %s ) AS %s'\
-             % (', '.join(f), inner_select, inner_table_name)
+        inner_select = '%s FROM ( SELECT %s%s ) AS %s'\
+             % (', '.join(f), distinct, inner_select, inner_table_name)
         
+        if self._using_total_count:
+            outer_fields = '_total_count, ' + outer_fields
+            inner_select = 'COUNT(*) OVER() as _total_count, ' + inner_select
+
         sql = "SELECT _row_num, %s FROM ( SELECT ROW_NUMBER() OVER ( ORDER BY %s) as _row_num, %s) as QQQ where %s"\
              % (outer_fields, order, inner_select, where_row_num)
         
         return sql, fields
 
+    def _is_existence_check(self):
+        """Return True if this is the query built by Query.has_results()."""
+        q = self.query
+        return not q.select and not q.default_cols and not q.aggregate_select \
+            and q.extra_select.keys() == ['a'] and q.extra_select['a'] == (u'1', []) \
+            and q.high_mark is not None and q.high_mark - q.low_mark == 1
+
+    def _as_exists_sql(self):
+        """
+        Return the SQL for an existence check.
+
+        The check is rewritten to "SELECT TOP 1 1" so the server can stop at
+        the first qualifying row from the narrowest index. DISTINCT does not
+        change whether a row exists and is dropped, as is the ordering
+        (has_results() never selects related tables). A check with an offset
+        only has to know whether more than `low_mark` rows exist, so it
+        counts the TOP `high_mark` rows instead of numbering them.
+        """
+        raw_sql, params = super(SQLCompiler, self).as_sql(False, False)
+        if not self.query.low_mark:
+            return _re_exists_select.sub('SELECT TOP 1 1', raw_sql, 1), params
+
+        inner = _re_exists_select.sub('SELECT TOP %d 1 AS [a]' % self.query.high_mark, raw_sql, 1)
+        sql = 'SELECT 1 FROM ( %s ) AS [exists_t] HAVING COUNT(*) > %d' % (inner, self.query.low_mark)
+        return sql, params
+
     def _alias_columns(self, sql):
         """Return tuple of SELECT and FROM clauses, aliasing duplicate column names."""
         qn = self.connection.ops.quote_name
@@ -204,30 +407,82 @@ class SQLInsertCompiler(compiler.SQLInsertCompiler, SQLCompiler):
         if not hasattr(self, 'return_id'):
             self.return_id = False
 
-        sql, params = super(SQLInsertCompiler, self).as_sql(*args, **kwargs)
+        # The id is selected below instead of with the return_insert_id()
+        # fragment django appends when return_id is set.
+        return_id, self.return_id = self.return_id, False
+        try:
+            sql, params = super(SQLInsertCompiler, self).as_sql(*args, **kwargs)
+        finally:
+            self.return_id = return_id
 
+        qn = self.connection.ops.quote_name
         meta = self.query.get_meta()
+        if self.return_id and self.connection.features.can_return_id_from_insert:
+            # Select the new id in the same batch. NOCOUNT keeps the insert
+            # (and any triggers) from returning closed recordsets ahead of
+            # the id. OUTPUT INSERTED is not used, as it fails on tables
+            # with triggers.
+            sql = "SET NOCOUNT ON;%s;SET NOCOUNT OFF;SELECT CAST(SCOPE_IDENTITY() AS bigint)" % sql
         
         if meta.has_auto_field:
             # db_column is None if not explicitly specified by model field
             auto_field_column = meta.auto_field.db_column or meta.auto_field.column
 
-            if auto_field_column in self.query.columns:
-                quoted_table = self.connection.ops.quote_name(meta.db_table)
-                sql = "SET IDENTITY_INSERT %s ON;%s;SET IDENTITY_INSERT %s OFF" %\
-                    (quoted_table, sql, quoted_table)
+            # The connection tracks the IDENTITY_INSERT state of the session,
+            # so it is only switched when needed.
+            before, after = self.connection.identity_insert_sql(
+                qn(meta.db_table), auto_field_column in self.query.columns)
+            sql = ';'.join([s for s in (before, sql, after) if s])
 
         return sql, params
 
 
 class SQLDeleteCompiler(compiler.SQLDeleteCompiler, SQLCompiler):
-    pass
+    def as_sql(self):
+        return self._with_rewritten_where(super(SQLDeleteCompiler, self).as_sql)
 
 class SQLUpdateCompiler(compiler.SQLUpdateCompiler, SQLCompiler):
-    pass
+    def as_sql(self):
+        # Return the new values of the given columns of the updated rows,
+        # see SqlServerQuerySet.update_returning().
+        returning = getattr(self.query, 'returning', None)
+        if not returning:
+            return self._with_rewritten_where(super(SQLUpdateCompiler, self).as_sql)
+
+        # The OUTPUT clause goes between the SET and WHERE clauses, so the
+        # UPDATE ... SET part is compiled without the where tree (after the
+        # setup, which may replace the tree).
+        self.pre_sql_setup()
+        where = self.query.where
+        self.query.where = self.query.where_class()
+        try:
+            sql, params = super(SQLUpdateCompiler, self).as_sql()
+        finally:
+            self.query.where = where
+        if not sql:
+            return sql, params
+
+        qn = self.connection.ops.quote_name
+        result = [sql, 'OUTPUT %s' % ', '.join(['INSERTED.%s' % qn(c) for c in returning])]
+        where_sql, where_params = rewrite_where(where, self.connection).as_sql(
+            qn=self.quote_name_unless_alias, connection=self.connection)
+        if where_sql:
+            result.append('WHERE %s' % where_sql)
+        return ' '.join(result), tuple(params) + tuple(where_params)
 
 class SQLAggregateCompiler(compiler.SQLAggregateCompiler, SQLCompiler):
-    pass
+    def as_sql(self, qn=None):
+        # Move the OPTION clause of the subquery to the end of the statement.
+        subquery = self.query.subquery
+        match = _re_query_hints.search(subquery)
+        if match is None:
+            return super(SQLAggregateCompiler, self).as_sql(qn)
+        self.query.subquery = subquery[:match.start()]
+        try:
+            sql, params = super(SQLAggregateCompiler, self).as_sql(qn)
+        finally:
+            self.query.subquery = subquery
+        return sql + match.group(0), params
 
 class SQLDateCompiler(compiler.SQLDateCompiler, SQLCompiler):
     pass
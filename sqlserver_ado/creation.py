@@ -31,6 +31,62 @@ class DatabaseCreation(BaseDatabaseCreation):
         'TimeField':            'datetime',
     }
 
+    # Catalog used for the full-text indexes of models without a fulltext_catalog.
+    default_fulltext_catalog = 'django_fulltext'
+
+    def sql_fulltext_for_model(self, model, style):
+        """
+        Returns the statements creating the full-text index declared by a
+        model, and its catalog if it does not exist.
+
+        Django does not allow custom Meta options, so the index is declared
+        with model attributes: ``fulltext_fields`` lists the names of the
+        indexed fields and ``fulltext_catalog`` optionally names the catalog.
+        The primary key is used as the key index.
+        """
+        fields = getattr(model, 'fulltext_fields', None)
+        if not fields or not model._meta.managed or model._meta.proxy:
+            return []
+        opts = model._meta
+        qn = self.connection.ops.quote_name
+        catalog = getattr(model, 'fulltext_catalog', None) or self.default_fulltext_catalog
+        columns = ', '.join([qn(opts.get_field(name).column) for name in fields])
+        return [
+            style.SQL_KEYWORD('IF NOT EXISTS') + " (SELECT * FROM sys.fulltext_catalogs WHERE name = '%s') " % catalog +
+                style.SQL_KEYWORD('CREATE FULLTEXT CATALOG') + ' ' + style.SQL_TABLE(qn(catalog)) + ';',
+            # The primary key constraint has a generated name, look it up.
+            style.SQL_KEYWORD('DECLARE') + ' @key_index sysname; ' +
+                "SELECT @key_index = name FROM sys.indexes WHERE object_id = OBJECT_ID('%s') AND is_primary_key = 1; " % qn(opts.db_table) +
+                style.SQL_KEYWORD('EXEC') + "('CREATE FULLTEXT INDEX ON %s (%s) KEY INDEX [' + @key_index + '] ON %s');" % (
+                    style.SQL_TABLE(qn(opts.db_table)), style.SQL_FIELD(columns), style.SQL_TABLE(qn(catalog))),
+        ]
+
+    def create_fulltext_indexes(self, verbosity=1, models=None):
+        """
+        Creates the full-text catalogs and indexes declared by the installed
+        models, or by the given models. Full-text statements cannot be run in
+        a transaction, so syncdb cannot create them; call this after syncdb.
+        """
+        from django.core.management.color import no_style
+        from django.db import router
+        from django.db.models import get_models
+        if models is None:
+            models = [m for m in get_models() if router.allow_syncdb(self.connection.alias, m)]
+
+        statements = []
+        for model in models:
+            statements.extend(self.sql_fulltext_for_model(model, no_style()))
+        if not statements:
+            return
+
+        cursor = self.connection.cursor()
+        self._disable_transactions(verbosity)
+        try:
+            for sql in statements:
+                cursor.execute(sql)
+        finally:
+            self._reenable_transactions(verbosity)
+
     def _disable_transactions(self, verbosity=1):
         """Temporarily turn off transactions for non-transactionable SQL"""
         if self.connection.connection.supportsTransactions:
@@ -80,6 +136,8 @@ class DatabaseCreation(BaseDatabaseCreation):
             database=self.connection.alias,
             load_initial_data=False)
 
+        self.create_fulltext_indexes(verbosity=max(verbosity - 1, 0))
+
         # We need to then do a flush to ensure that any data installed by
         # custom SQL has been removed. The only test data should come from
         # test fixtures, or autogenerated from post_syncdb triggers.
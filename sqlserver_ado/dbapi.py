@@ -228,6 +228,15 @@ class Connection(object):
         v = self.adoConnProperties.get('DBMS Version', '')
         return v.startswith(unicode(VERSION_SQL2008))
 
+    @property
+    def server_version(self):
+        """The major version of the server, e.g. 10 for SQL Server 2008."""
+        v = self.adoConnProperties.get('DBMS Version', '')
+        try:
+            return int(v.split('.')[0])
+        except ValueError:
+            return None
+
     def _raiseConnectionError(self, errorclass, errorvalue):
         eh = self.errorhandler
         if eh is None:
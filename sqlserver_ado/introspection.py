@@ -125,6 +125,21 @@ where
 
         return indexes
 
+    def get_fulltext_columns(self, cursor, table_name):
+        "Returns the names of the columns of the given table that have a full-text index."
+        sql = """
+select
+	C.name
+from
+	sys.tables T
+	join sys.fulltext_index_columns FIC on FIC.object_id = T.object_id
+	join sys.columns C on C.object_id = T.object_id and C.column_id = FIC.column_id
+where
+	T.name = %s
+"""
+        cursor.execute(sql,[table_name])
+        return [row[0] for row in cursor.fetchall()]
+
 
     data_types_reverse = {
         ado_consts.AUTO_FIELD_MARKER: 'AutoField',
@@ -1,11 +1,839 @@
+from django.db import transaction
 from django.db.backends import BaseDatabaseOperations
+from django.utils import simplejson
 import datetime
+import itertools
+import re
 import time
 
+import dbapi as Database
+
+# Characters that must be escaped in a LIKE pattern, mapped to their escaped form.
+_like_escapes = dict([(ord(ch), u'\\' + ch) for ch in u'\\%_[]'])
+
+# The JSON encoding of values of SQL Server data types, for json_chunks().
+_json_numeric_types = ('bigint', 'int', 'smallint', 'tinyint', 'decimal', 'numeric', 'money', 'smallmoney')
+_json_float_types = ('float', 'real')
+_json_date_types = ('date', 'datetime', 'datetime2', 'smalldatetime', 'datetimeoffset', 'time')
+
+# The data type name at the start of a column definition.
+_re_type_name = re.compile(r'^\s*(\w+)')
+
+# Numbers the temp tables created by staged_keys().
+_staged_counter = itertools.count(1)
+
+
+class StagedKeys(object):
+    """
+    A temp table of keys for the lifetime of a with block, see
+    DatabaseOperations.staged_keys().
+
+    ``name`` is the (quoted) name of the table and ``columns`` the quoted
+    names of its columns; the table name is also the string value.
+    """
+    def __init__(self, ops, values, types):
+        if isinstance(types, basestring):
+            types = [types]
+            values = [(v,) for v in values]
+        self.ops = ops
+        self.values = values
+        self.types = list(types)
+        self.name = ops.quote_name('#staged_%d' % _staged_counter.next())
+        if len(self.types) == 1:
+            names = ['key']
+        else:
+            names = ['key%d' % i for i in xrange(1, len(self.types) + 1)]
+        self.columns = [ops.quote_name(n) for n in names]
+
+    def __str__(self):
+        return self.name
+
+    def __enter__(self):
+        ops = self.ops
+        cursor = ops.connection.cursor()
+        sql = "CREATE TABLE %s (%s, PRIMARY KEY CLUSTERED (%s) WITH (IGNORE_DUP_KEY = ON))" % (
+            self.name,
+            ', '.join(['%s %s NOT NULL' % (c, t) for c, t in zip(self.columns, self.types)]),
+            ', '.join(self.columns))
+        # Parameterized statements run in their own scope (sp_executesql),
+        # which would drop the temp table again, so it is created on its own.
+        cursor.execute(sql)
+        for batch in ops._batches(list(self.values), len(self.columns)):
+            placeholders = [['%s'] * len(self.columns)] * len(batch)
+            params = [v for row in batch for v in row]
+            cursor.execute("INSERT INTO %s (%s) SELECT * FROM %s" % (self.name,
+                ', '.join(self.columns), ops._derived_table_sql(placeholders, self.columns)), params)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        cursor = self.ops.connection.cursor()
+        cursor.execute("IF OBJECT_ID('tempdb..%s') IS NOT NULL DROP TABLE %s" % (self.name, self.name))
+        return False
+
 
 class DatabaseOperations(BaseDatabaseOperations):
     compiler_module = "sqlserver_ado.compiler"
+
+    # SQL Server accepts at most 2100 parameters in a request. Statements
+    # built from many rows are split into batches using fewer than this.
+    max_query_params = 2000
+
+    # The most rows allowed in a VALUES list
+    max_values_rows = 1000
+
+    # __in lookups with more values than this are sent as one parameter,
+    # shredded on the server with the given strategy ('xml' or 'delimited').
+    # See where.LargeInNode. Set from the 'large_in_threshold' and
+    # 'large_in_strategy' database OPTIONS.
+    large_in_threshold = 1000
+    large_in_strategy = 'xml'
     
+    def approximate_count(self, model, exact_threshold=None):
+        """
+        Return a tuple of (row_count, is_exact) for the table of the given
+        model class or table name.
+
+        The count is read from the per partition row counts of the heap or
+        clustered index in sys.partitions, which avoids scanning the table
+        but is only an estimate. If the estimate is below `exact_threshold`,
+        or the table has no statistics, an exact COUNT(*) is run instead.
+        """
+        if isinstance(model, basestring):
+            table = model
+        else:
+            table = model._meta.db_table
+
+        cursor = self.connection.cursor()
+        count = self._partition_row_counts(cursor, [table]).get(table.lower())
+        if count is not None and (exact_threshold is None or count >= exact_threshold):
+            return count, False
+
+        cursor.execute("SELECT COUNT_BIG(*) FROM %s" % self.quote_name(table))
+        return cursor.fetchone()[0], True
+
+    def key_boundaries(self, model, count):
+        """
+        Returns up to ``count - 1`` ascending primary key values that split
+        the table of the given model into ``count`` ranges of about the same
+        number of rows, each range ending with (and including) a boundary.
+
+        The boundaries are picked from the histogram of the statistics on
+        the primary key, so the table is not scanned. If the histogram can
+        not be read (it is empty, or DBCC SHOW_STATISTICS is not permitted)
+        an integer key range is split evenly between its MIN and MAX values,
+        and other keys are not split.
+        """
+        opts = model._meta
+        if count < 2:
+            return []
+        cursor = self.connection.cursor()
+        try:
+            steps = self._key_histogram(cursor, opts)
+        except Database.DatabaseError:
+            steps = []
+        if steps:
+            total = float(sum([rows for key, rows in steps]))
+            boundaries = []
+            seen = 0
+            for key, rows in steps[:-1]:
+                seen += rows
+                if seen * count >= total * (len(boundaries) + 1):
+                    boundaries.append(key)
+                    if len(boundaries) == count - 1:
+                        break
+            return boundaries
+
+        cursor.execute("SELECT MIN(%(pk)s), MAX(%(pk)s) FROM %(table)s" % {
+            'pk': self.quote_name(opts.pk.column),
+            'table': self.quote_name(opts.db_table),
+        })
+        low, high = cursor.fetchone()
+        if not isinstance(low, (int, long)) or not isinstance(high, (int, long)):
+            return []
+        boundaries = []
+        for i in xrange(1, count):
+            key = low + (high - low) * i // count
+            if key < high and (not boundaries or key > boundaries[-1]):
+                boundaries.append(key)
+        return boundaries
+
+    def _key_histogram(self, cursor, opts):
+        """
+        Return a list of (range_hi_key, rows) tuples from the histogram of
+        the statistics on the primary key of the given model, where rows is
+        the estimated number of rows after the previous key up to and
+        including range_hi_key.
+        """
+        cursor.execute("SELECT [name] FROM sys.indexes WHERE [object_id] = OBJECT_ID(%s) AND [is_primary_key] = 1",
+            [self.quote_name(opts.db_table)])
+        row = cursor.fetchone()
+        if row is None:
+            return []
+        cursor.execute("DBCC SHOW_STATISTICS ('%s', '%s') WITH HISTOGRAM, NO_INFOMSGS" % (
+            self.quote_name(opts.db_table).replace("'", "''"), row[0].replace("'", "''")))
+        return [(r[0], r[1] + r[2]) for r in cursor.fetchall()]
+
+    def _partition_row_counts(self, cursor, tables):
+        """
+        Return a dictionary of {table_name: row_count}, keyed by the lower
+        cased table name, read from sys.partitions for the given tables.
+        """
+        if not tables:
+            return dict()
+        sql = "SELECT OBJECT_NAME(object_id), SUM(rows) FROM sys.partitions " \
+            "WHERE index_id IN (0, 1) AND object_id IN (%s) GROUP BY object_id" % \
+            ', '.join(['OBJECT_ID(%s)'] * len(tables))
+        cursor.execute(sql, [self.quote_name(t) for t in tables])
+        return dict([(name.lower(), count) for name, count in cursor.fetchall()])
+
+    def _batches(self, rows, params_per_row, batch_size=None):
+        """Split rows into batches that stay below max_query_params and max_values_rows."""
+        size = min(self.max_query_params // max(params_per_row, 1), self.max_values_rows)
+        if batch_size:
+            size = min(size, batch_size)
+        size = max(size, 1)
+        return [rows[i:i + size] for i in xrange(0, len(rows), size)]
+
+    def _insert_values(self, fields, objs, add=True):
+        """Return the placeholders (one list per object) and parameters to save objs."""
+        placeholders, params = [], []
+        for obj in objs:
+            row = []
+            for f in fields:
+                value = f.get_db_prep_save(f.pre_save(obj, add), connection=self.connection)
+                if hasattr(f, 'get_placeholder'):
+                    row.append(f.get_placeholder(value, self.connection))
+                else:
+                    row.append('%s')
+                params.append(value)
+            placeholders.append(row)
+        return placeholders, params
+
+    def bulk_insert(self, objs, batch_size=None):
+        """
+        Inserts a list of model instances of the same model with one
+        statement per batch of rows, and sets the generated primary keys on
+        the instances that did not have one. Returns objs.
+
+        The rows are inserted with a MERGE whose OUTPUT clause returns the
+        generated key together with the position of the row, so keys are
+        matched to the instances in order. SQL Server 2005 has no MERGE; the
+        rows are inserted with INSERT ... SELECT ... ORDER BY, which assigns
+        identity values in order, and the keys are matched in ascending
+        order. Batches stay below the parameter limit (see max_query_params)
+        and, if given, batch_size rows.
+
+        Like QuerySet.update(), this does not call save() or send signals,
+        and commits unless a transaction is managed. Models with multi-table
+        inheritance are not supported.
+        """
+        if not objs:
+            return objs
+        opts = objs[0]._meta
+        if opts.parents:
+            raise ValueError("bulk_insert() does not support multi-table inherited models.")
+
+        auto_field = opts.auto_field
+        with_pk = [obj for obj in objs if auto_field is None or obj.pk is not None]
+        without_pk = [obj for obj in objs if auto_field is not None and obj.pk is None]
+
+        cursor = self.connection.cursor()
+        qn = self.quote_name
+        table = qn(opts.db_table)
+
+        fields = opts.local_fields
+        columns = ', '.join([qn(f.column) for f in fields])
+        for batch in self._batches(with_pk, len(fields), batch_size):
+            placeholders, params = self._insert_values(fields, batch)
+            sql = 'INSERT INTO %s (%s) %s' % (table, columns,
+                ' UNION ALL '.join(['SELECT %s' % ', '.join(row) for row in placeholders]))
+            cursor.execute(self._with_identity_insert(opts, fields, sql), params)
+
+        fields = [f for f in opts.local_fields if f is not auto_field]
+        for batch in self._batches(without_pk, len(fields), batch_size):
+            placeholders, params = self._insert_values(fields, batch)
+            if self.is_sql2008():
+                sql = self._bulk_insert_merge_sql(opts, fields, placeholders)
+            else:
+                sql = self._bulk_insert_ordered_sql(opts, fields, placeholders)
+            cursor.execute(self._with_identity_insert(opts, fields, sql), params)
+            for obj, row in zip(batch, cursor.fetchall()):
+                setattr(obj, auto_field.attname, auto_field.to_python(row[0]))
+        transaction.commit_unless_managed(self.connection.alias)
+
+        for obj in objs:
+            obj._state.db = self.connection.alias
+            obj._state.adding = False
+        return objs
+
+    def _bulk_insert_merge_sql(self, opts, fields, placeholders):
+        qn = self.quote_name
+        columns = [qn(f.column) for f in fields]
+        source_rows = ', '.join(['(%s)' % ', '.join(row + [str(i)]) for i, row in enumerate(placeholders)])
+        if columns:
+            insert = 'INSERT (%s) VALUES (%s)' % (', '.join(columns),
+                ', '.join(['[source].%s' % c for c in columns]))
+        else:
+            insert = 'INSERT DEFAULT VALUES'
+        # NOCOUNT keeps the MERGE from returning a closed recordset ahead of the keys.
+        return "SET NOCOUNT ON;" \
+            "DECLARE @inserted TABLE ([_ordinal] int PRIMARY KEY, [pk] bigint);" \
+            "MERGE INTO %s USING (VALUES %s) AS [source] (%s) ON 1 = 0 " \
+            "WHEN NOT MATCHED THEN %s " \
+            "OUTPUT [source].[_ordinal], INSERTED.%s INTO @inserted;" \
+            "SET NOCOUNT OFF;" \
+            "SELECT [pk] FROM @inserted ORDER BY [_ordinal]" % (
+            qn(opts.db_table), source_rows, ', '.join(columns + ['[_ordinal]']),
+            insert, qn(opts.auto_field.column))
+
+    def _bulk_insert_ordered_sql(self, opts, fields, placeholders):
+        qn = self.quote_name
+        columns = [qn(f.column) for f in fields]
+        if not columns:
+            raise ValueError("bulk_insert() needs SQL Server 2008 for models without fields other than the primary key.")
+        source = ' UNION ALL '.join(['SELECT %s' % ', '.join(
+            ['%s AS %s' % (p, c) for p, c in zip(row, columns)] + ['%d AS [_ordinal]' % i])
+            for i, row in enumerate(placeholders)])
+        return "SET NOCOUNT ON;" \
+            "DECLARE @inserted TABLE ([pk] bigint);" \
+            "INSERT INTO %s (%s) OUTPUT INSERTED.%s INTO @inserted " \
+            "SELECT %s FROM (%s) AS [source] ORDER BY [_ordinal];" \
+            "SET NOCOUNT OFF;" \
+            "SELECT [pk] FROM @inserted ORDER BY [pk]" % (
+            qn(opts.db_table), ', '.join(columns), qn(opts.auto_field.column),
+            ', '.join(columns), source)
+
+    def _get_field(self, opts, name):
+        """Return the local field with the given name or attname (e.g. "author_id")."""
+        for f in opts.local_fields:
+            if name in (f.name, f.attname):
+                return f
+        if name == 'pk':
+            return opts.pk
+        return opts.get_field(name)
+
+    def _with_identity_insert(self, opts, fields, sql):
+        """Add the IDENTITY_INSERT switches needed to insert the given fields to sql."""
+        if opts.auto_field is None:
+            return sql
+        before, after = self.connection.identity_insert_sql(
+            self.quote_name(opts.db_table), opts.auto_field in fields)
+        if before:
+            sql = '%s;%s' % (before, sql)
+        if after:
+            sql = '%s;%s' % (sql.rstrip(';'), after)
+        return sql
+
+    def _pk_db_type(self, opts):
+        """Return the column type of the primary key, without any IDENTITY."""
+        from django.db.models import AutoField
+        pk = opts.pk
+        if isinstance(pk, AutoField):
+            if pk.get_internal_type() == 'BigAutoField':
+                return 'bigint'
+            return 'int'
+        return pk.db_type(connection=self.connection)
+
+    def bulk_upsert(self, model, rows, key_fields, update_fields=None, batch_size=None, returning=False):
+        """
+        Inserts or updates rows of the given model, matching them to the
+        existing rows by the fields named in `key_fields`.
+
+        `rows` is a list of model instances or of dictionaries of field
+        values; missing fields get their default value when inserted. Rows
+        that exist get the fields in `update_fields` updated, which defaults
+        to the fields given in the first dictionary, or to every field for
+        instances, other than the keys. With an empty list, existing rows are
+        left alone. The keys must be unique within `rows`.
+
+        Each batch of rows is merged with a single MERGE ... WITH (HOLDLOCK)
+        from a VALUES list, so concurrent upserts of the same keys cannot
+        both insert. Returns the number of rows inserted or updated, or with
+        `returning`, a list of ('INSERT' or 'UPDATE', pk) tuples. Commits
+        unless a transaction is managed.
+
+        Requires SQL Server 2008.
+        """
+        if not self.is_sql2008():
+            raise Database.DatabaseError("bulk_upsert() requires SQL Server 2008 or later.")
+        opts = model._meta
+        if opts.parents:
+            raise ValueError("bulk_upsert() does not support multi-table inherited models.")
+        if not rows:
+            return returning and [] or 0
+
+        key_fields = [self._get_field(opts, name) for name in key_fields]
+        if update_fields is None:
+            if isinstance(rows[0], dict):
+                update_fields = [self._get_field(opts, name) for name in rows[0]]
+            else:
+                update_fields = list(opts.local_fields)
+            update_fields = [f for f in update_fields if f not in key_fields and f is not opts.auto_field]
+        else:
+            update_fields = [self._get_field(opts, name) for name in update_fields]
+
+        objs = [isinstance(row, dict) and model(**row) or row for row in rows]
+        fields = [f for f in opts.local_fields if f is not opts.auto_field or f in key_fields]
+
+        qn = self.quote_name
+        columns = [qn(f.column) for f in fields]
+        sql = "MERGE INTO %s WITH (HOLDLOCK) AS [target] USING (VALUES %%s) AS [source] (%s) ON %s " % (
+            qn(opts.db_table), ', '.join(columns),
+            ' AND '.join(['[target].%s = [source].%s' % (qn(f.column), qn(f.column)) for f in key_fields]))
+        if update_fields:
+            sql += "WHEN MATCHED THEN UPDATE SET %s " % ', '.join(
+                ['[target].%s = [source].%s' % (qn(f.column), qn(f.column)) for f in update_fields])
+        sql += "WHEN NOT MATCHED THEN INSERT (%s) VALUES (%s)" % (
+            ', '.join(columns), ', '.join(['[source].%s' % c for c in columns]))
+        if returning:
+            # NOCOUNT keeps the MERGE from returning a closed recordset ahead
+            # of the changes; OUTPUT INTO works on tables with triggers.
+            sql = "SET NOCOUNT ON;" \
+                "DECLARE @changes TABLE ([action] nvarchar(10), [pk] %s);" \
+                "%s OUTPUT $action, INSERTED.%s INTO @changes;" \
+                "SET NOCOUNT OFF;" \
+                "SELECT [action], [pk] FROM @changes" % (
+                self._pk_db_type(opts), sql, qn(opts.pk.column))
+        else:
+            sql += ";"
+        sql = self._with_identity_insert(opts, fields, sql)
+
+        cursor = self.connection.cursor()
+        changes, count = [], 0
+        for batch in self._batches(objs, len(fields), batch_size):
+            placeholders, params = self._insert_values(fields, batch)
+            cursor.execute(sql % ', '.join(['(%s)' % ', '.join(row) for row in placeholders]), params)
+            if returning:
+                changes.extend([(action, opts.pk.to_python(pk)) for action, pk in cursor.fetchall()])
+            else:
+                count += cursor.rowcount
+        transaction.commit_unless_managed(self.connection.alias)
+        if returning:
+            return changes
+        return count
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        """
+        Saves the given fields of a list of model instances of the same
+        model with one UPDATE per batch of rows, and returns the number of
+        rows updated.
+
+        Each batch joins the table to a derived table of the primary keys
+        and new values, "UPDATE t SET ... FROM t JOIN (VALUES ...) AS v ON
+        t.pk = v.pk", so each row can get different values. Batches stay
+        below the parameter limit (see max_query_params) and, if given,
+        batch_size rows. No save() signals are sent, and the updates are
+        committed unless a transaction is managed.
+        """
+        if not objs:
+            return 0
+        opts = objs[0]._meta
+        fields = [self._get_field(opts, name) for name in fields]
+        for f in fields:
+            if f.primary_key or f not in opts.local_fields:
+                raise ValueError("bulk_update() can only update local, non primary key fields: %s" % f.name)
+
+        qn = self.quote_name
+        table = qn(opts.db_table)
+        pk_column = qn(opts.pk.column)
+        columns = [pk_column] + [qn(f.column) for f in fields]
+        sql = "UPDATE [target] SET %s FROM %s AS [target] INNER JOIN %%s ON [target].%s = [source].%s" % (
+            ', '.join(['%s = [source].%s' % (c, c) for c in columns[1:]]),
+            table, pk_column, pk_column)
+
+        cursor = self.connection.cursor()
+        count = 0
+        for batch in self._batches(objs, len(columns), batch_size):
+            placeholders, params = self._insert_values([opts.pk] + fields, batch, add=False)
+            cursor.execute(sql % self._derived_table_sql(placeholders, columns), params)
+            count += cursor.rowcount
+        transaction.commit_unless_managed(self.connection.alias)
+        return count
+
+    def _derived_table_sql(self, placeholders, columns, alias='[source]'):
+        """
+        Return a derived table of the given rows of placeholders, with the
+        given (quoted) column names. SQL Server 2005 has no VALUES lists.
+        """
+        if self.is_sql2008():
+            return '(VALUES %s) AS %s (%s)' % (
+                ', '.join(['(%s)' % ', '.join(row) for row in placeholders]),
+                alias, ', '.join(columns))
+        return '(%s) AS %s' % (' UNION ALL '.join(['SELECT %s' % ', '.join(
+            ['%s AS %s' % (p, c) for p, c in zip(row, columns)]) for row in placeholders]), alias)
+
+    def staged_keys(self, values, types='int'):
+        """
+        Returns a context manager that loads values into a temp table
+        with a clustered primary key, and drops the table when the with
+        block exits. Use it to join a large set of keys computed in Python
+        with a table in raw SQL or .extra(), e.g.
+
+            with connection.ops.staged_keys(ids) as keys:
+                Book.objects.extra(where=['[id] IN (SELECT [key] FROM %s)' % keys])
+
+        ``types`` is the SQL data type of the values, or a list of types if
+        each value is a tuple. The columns are named [key], or [key1],
+        [key2]... for tuples, and duplicate keys are ignored. The table is
+        loaded with as few INSERTs as the parameter limit allows. A temp
+        table belongs to the session, so the connection must stay open
+        inside the block.
+        """
+        return StagedKeys(self, values, types)
+
+    def tree_query(self, queryset, parent_field, max_depth=None, ancestors=False):
+        """
+        Returns the rows of the given queryset together with all of their
+        descendants (or with ``ancestors``, all of their ancestors) in a
+        self-referential hierarchy, fetched with one recursive CTE.
+
+        ``parent_field`` is the name of the ForeignKey to the model itself.
+        The instances are returned depth first, each with a ``tree_depth``
+        attribute (0 for the rows of the queryset) and a ``tree_path``
+        attribute, the primary keys from the starting row down to the row
+        in the form '/1/4/9/'. ``max_depth`` limits the number of levels
+        followed; without it SQL Server stops with an error after 100
+        levels. Cycles in the hierarchy are not followed.
+        """
+        opts = queryset.model._meta
+        if opts.parents:
+            raise ValueError("tree_query() does not support inherited models.")
+        qn = self.quote_name
+        table = qn(opts.db_table)
+        pk = qn(opts.pk.column)
+        parent = qn(self._get_field(opts, parent_field).column)
+        columns = [qn(f.column) for f in opts.fields]
+
+        keys = queryset.order_by().values_list('pk').query
+        key_sql, key_params = keys.get_compiler(connection=self.connection).as_nested_sql()
+
+        if self._pk_db_type(opts) in ('int', 'bigint'):
+            # Ordering by the binary keys of the path sorts the rows depth first.
+            order_sql = 'CAST(%s AS binary(8))'
+        else:
+            order_sql = 'CAST(%s AS nvarchar(4000))'
+        key_text = 'CAST(%s AS nvarchar(4000))'
+        if ancestors:
+            join = '[child].%s = [tree].[_parent]' % pk
+        else:
+            join = '[child].%s = [tree].[_key]' % parent
+        depth_sql = ''
+        if max_depth is not None:
+            depth_sql = ' AND [tree].[_depth] < %d' % max_depth
+
+        sql = "WITH [tree] ([_key], [_parent], [_depth], [_path], [_order], %(columns)s) AS (" \
+            "SELECT %(pk)s, %(parent)s, 0, CAST(N'/' + %(key)s + N'/' AS nvarchar(max)), " \
+            "CAST(%(order)s AS varbinary(max)), %(columns)s FROM %(table)s WHERE %(pk)s IN (%(keys)s) " \
+            "UNION ALL " \
+            "SELECT [child].%(pk)s, [child].%(parent)s, [tree].[_depth] + 1, " \
+            "CAST([tree].[_path] + %(child_key)s + N'/' AS nvarchar(max)), " \
+            "CAST([tree].[_order] + %(child_order)s AS varbinary(max)), %(child_columns)s " \
+            "FROM %(table)s AS [child] INNER JOIN [tree] ON %(join)s " \
+            "WHERE CHARINDEX(N'/' + %(child_key)s + N'/', [tree].[_path]) = 0%(depth)s) " \
+            "SELECT [_depth], [_path], %(columns)s FROM [tree] ORDER BY [_order]" % {
+                'columns': ', '.join(columns),
+                'child_columns': ', '.join(['[child].%s' % c for c in columns]),
+                'pk': pk, 'parent': parent, 'table': table, 'keys': key_sql, 'join': join,
+                'key': key_text % pk, 'child_key': key_text % ('[child].%s' % pk),
+                'order': order_sql % pk, 'child_order': order_sql % ('[child].%s' % pk),
+                'depth': depth_sql,
+            }
+        if max_depth is not None and max_depth >= 100:
+            sql += ' OPTION (MAXRECURSION %d)' % min(max_depth, 32767)
+
+        cursor = self.connection.cursor()
+        cursor.execute(sql, key_params)
+        objs = []
+        for row in cursor.fetchall():
+            obj = queryset.model(*row[2:])
+            obj._state.db = self.connection.alias
+            obj._state.adding = False
+            obj.tree_depth, obj.tree_path = row[0], row[1]
+            objs.append(obj)
+        return objs
+
+    def json_chunks(self, queryset, chunk_size=100, encoding=None):
+        """
+        Returns an iterator of text chunks that together form a JSON array
+        with an object for each row of the queryset, built by the server.
+
+        The objects have the names and values of queryset.values(), or of
+        the queryset itself if it already is a values() queryset. The rows
+        are not converted to Python values and serialized again, which
+        saves most of the time spent on large JSON responses. SQL Server
+        2016 and later build the array with FOR JSON PATH. Older versions
+        build a JSON object string for each row, and ``chunk_size`` of those
+        are joined into each chunk. In that case strings containing control
+        characters other than tab, CR and LF are not escaped.
+
+        If ``encoding`` is given the chunks are encoded to byte strings.
+        Slices with an offset are not supported.
+        """
+        from django.db.models.query import ValuesQuerySet
+        from compiler import _re_query_hints
+        if not isinstance(queryset, ValuesQuerySet):
+            queryset = queryset.values()
+        query = queryset.query
+        if query.low_mark:
+            raise ValueError("json_chunks() does not support slices with an offset.")
+        # The names in the order of the columns, as in ValuesQuerySet.iterator().
+        names = query.extra_select.keys() + list(queryset.field_names) + \
+            query.aggregate_select.keys()
+
+        compiler = query.get_compiler(connection=self.connection)
+        qn = compiler.quote_name_unless_alias
+        exprs = ['(%s)' % query.extra_select[name][0] for name in query.extra_select]
+        exprs += ['%s.%s' % (qn(alias), qn(column)) for alias, column in query.select]
+        exprs += [aggregate.as_sql(qn, self.connection) for aggregate in query.aggregate_select.values()]
+        fields = [None] * len(query.extra_select) + list(query.select_fields) + \
+            [None] * len(query.aggregate_select)
+        # Expressions with parameters can only be used once.
+        once = [bool(extra_params) for extra_sql, extra_params in query.extra_select.values()] + \
+            [False] * (len(fields) - len(query.extra_select))
+
+        for_json = (self.server_version() or 0) >= 13
+        if for_json:
+            compiler.select_list = ['%s AS %s' % (e, self.quote_name(n)) for e, n in zip(exprs, names)]
+        else:
+            compiler.select_list = ["N'{' + %s + N'}'" % " + N',' + ".join(["N'%s:' + %s" % (
+                simplejson.dumps(name).replace("'", "''"), self._json_value_sql(e, f, o))
+                for e, f, o, name in zip(exprs, fields, once, names)])]
+            if query.distinct:
+                # The ORDER BY of a DISTINCT query can only use selected columns.
+                if True in once:
+                    raise ValueError("json_chunks() does not support distinct querysets "
+                        "with extra select parameters on this server version.")
+                compiler.keep_columns = True
+        sql, params = compiler.as_sql()
+        if for_json and query.ordering_aliases:
+            raise ValueError("json_chunks() cannot order a distinct queryset by columns "
+                "that are not selected.")
+
+        cursor = self.connection.cursor()
+        if for_json:
+            # FOR JSON goes before the OPTION clause of any query hints.
+            match = _re_query_hints.search(sql)
+            i = match and match.start() or len(sql)
+            sql = "%s FOR JSON PATH, INCLUDE_NULL_VALUES%s" % (sql[:i], sql[i:])
+            cursor.execute(sql, params)
+            return self.json_from_cursor(cursor, chunk_size, encoding, empty=u'[]')
+        cursor.execute(sql, params)
+        return self._json_rows(cursor, chunk_size, encoding)
+
+    def _json_rows(self, cursor, chunk_size, encoding):
+        """Yield a JSON array of the JSON object strings of the rows of a cursor."""
+        separator = u'['
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunk = separator + u','.join([row[0] for row in rows])
+            separator = u','
+            yield encoding and chunk.encode(encoding) or chunk
+        chunk = separator == u'[' and u'[]' or u']'
+        yield encoding and chunk.encode(encoding) or chunk
+
+    def json_from_cursor(self, cursor, chunk_size=100, encoding=None, empty=u''):
+        """
+        Yields the text of a FOR JSON result, which SQL Server returns as
+        rows of up to 2033 characters, from an executed cursor. ``empty``
+        is yielded if the result has no rows.
+        """
+        found = False
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            found = True
+            chunk = u''.join([row[0] for row in rows])
+            yield encoding and chunk.encode(encoding) or chunk
+        if not found and empty:
+            yield encoding and empty.encode(encoding) or empty
+
+    def _json_value_sql(self, expr, field=None, once=False):
+        """
+        Returns SQL for the JSON encoding of the value of expr, a column of
+        the given field. The type of other expressions is found out at run
+        time, unless the expression may only be used ``once``.
+        """
+        type_name = None
+        if field is not None:
+            match = _re_type_name.match(field.db_type(connection=self.connection) or '')
+            if match:
+                type_name = match.group(1).lower()
+        if type_name in _json_numeric_types:
+            return "ISNULL(CAST(%s AS nvarchar(50)), N'null')" % expr
+        if type_name in _json_float_types:
+            return "ISNULL(CONVERT(nvarchar(50), %s, 2), N'null')" % expr
+        if type_name == 'bit':
+            return "CASE %s WHEN 1 THEN N'true' WHEN 0 THEN N'false' ELSE N'null' END" % expr
+        if type_name in _json_date_types:
+            return "ISNULL(N'\"' + CONVERT(nvarchar(50), %s, 126) + N'\"', N'null')" % expr
+        string = "ISNULL(N'\"' + %s + N'\"', N'null')" % (
+            "REPLACE(REPLACE(REPLACE(REPLACE(REPLACE(CAST(%s AS nvarchar(max)), "
+            "N'\\', N'\\\\'), N'\"', N'\\\"'), NCHAR(10), N'\\n'), NCHAR(13), N'\\r'), "
+            "NCHAR(9), N'\\t')") % expr
+        if type_name is not None or once:
+            return string
+        # An extra select or aggregate of unknown type.
+        return "CASE WHEN CAST(SQL_VARIANT_PROPERTY(CAST(%s AS sql_variant), 'BaseType') AS nvarchar(50)) " \
+            "IN (%s) THEN CAST(%s AS nvarchar(50)) ELSE %s END" % (expr,
+            ', '.join(["N'%s'" % t for t in _json_numeric_types + _json_float_types]), expr, string)
+
+    def purge(self, queryset, archive=None, batch_size=5000, pause=0, progress=None):
+        """
+        Deletes the rows of a queryset in batches of at most batch_size rows,
+        committing after each batch, and returns the number of rows deleted.
+        Inside a managed transaction the batches are not committed but left
+        to the caller's transaction, which then holds the locks of every
+        batch until it ends.
+
+        A single large DELETE escalates to a table lock and has to keep the
+        whole delete in the transaction log until it commits. Each batch here
+        deletes the batch_size lowest primary keys with DELETE TOP, so locks
+        are held briefly and the log can be reused between batches. If
+        ``archive`` (a model or table name with the same columns) is given,
+        the deleted rows are copied into it with OUTPUT DELETED ... INTO in
+        the same statement. The archive table cannot have triggers or
+        foreign keys.
+
+        ``pause`` is the number of seconds to sleep between batches to let
+        other sessions through. ``progress`` is called with the running
+        total after each batch that deleted rows and may return False to
+        stop early. Since every batch is committed, a stopped or failed purge
+        outside of a managed transaction is resumed by running it again.
+
+        Unlike QuerySet.delete(), related objects are not collected and no
+        delete signals are sent.
+        """
+        if not queryset.query.can_filter():
+            raise ValueError("Cannot use 'limit' or 'offset' with purge().")
+        opts = queryset.model._meta
+        qn = self.quote_name
+        using = self.connection.alias
+
+        keys = queryset.order_by().values_list('pk').query
+        key_sql, key_params = keys.get_compiler(connection=self.connection).as_sql()
+        pk_column = qn(opts.pk.column)
+        sql = "WITH [batch] AS (SELECT TOP (%d) * FROM %s WHERE %s IN (%s) ORDER BY %s) DELETE FROM [batch]" % (
+            batch_size, qn(opts.db_table), pk_column, key_sql, pk_column)
+        if archive is not None:
+            if not isinstance(archive, basestring):
+                archive = archive._meta.db_table
+            columns = [qn(f.column) for f in opts.local_fields]
+            sql += " OUTPUT %s INTO %s (%s)" % (
+                ', '.join(['DELETED.%s' % c for c in columns]), qn(archive), ', '.join(columns))
+
+        cursor = self.connection.cursor()
+        total = 0
+        while True:
+            cursor.execute(sql, key_params)
+            count = cursor.rowcount
+            transaction.commit_unless_managed(using)
+            total += count
+            if count < batch_size:
+                break
+            if progress is not None and progress(total) is False:
+                return total
+            if pause:
+                time.sleep(pause)
+        if progress is not None and count:
+            progress(total)
+        return total
+
+    def get_or_create(self, model, defaults=None, **lookup):
+        """
+        Like QuerySet.get_or_create(), but in one round trip: returns a
+        tuple of (instance, created).
+
+        The keyword arguments name the fields that identify the row, which
+        is inserted with a MERGE ... WITH (HOLDLOCK) if it does not exist,
+        together with the `defaults`, and selected in the same batch. No
+        save() signals are sent, and the insert is committed unless a
+        transaction is managed. SQL Server 2005 has no MERGE, so there the
+        default manager's get_or_create() is used instead.
+        """
+        if not self.is_sql2008():
+            manager = model._default_manager.db_manager(self.connection.alias)
+            return manager.get_or_create(defaults=defaults, **lookup)
+        opts = model._meta
+        if opts.parents:
+            raise ValueError("get_or_create() does not support multi-table inherited models.")
+        params = dict(lookup)
+        params.update(defaults or {})
+        obj = model(**params)
+
+        key_fields = [self._get_field(opts, name) for name in lookup]
+        fields = [f for f in opts.local_fields if f is not opts.auto_field or f in key_fields]
+        placeholders, params = self._insert_values(fields, [obj])
+        key_placeholders, key_params = self._insert_values(key_fields, [obj])
+
+        qn = self.quote_name
+        columns = [qn(f.column) for f in fields]
+        select_columns = ', '.join(['[target].%s' % qn(f.column) for f in opts.local_fields])
+        sql = "SET NOCOUNT ON;" \
+            "DECLARE @created int;" \
+            "MERGE INTO %s WITH (HOLDLOCK) AS [target] USING (VALUES (%s)) AS [source] (%s) ON %s " \
+            "WHEN NOT MATCHED THEN INSERT (%s) VALUES (%s);" \
+            "SET @created = @@ROWCOUNT;" \
+            "SET NOCOUNT OFF;" \
+            "SELECT @created, %s FROM %s AS [target] WHERE %s" % (
+            qn(opts.db_table), ', '.join(placeholders[0]), ', '.join(columns),
+            ' AND '.join(['[target].%s = [source].%s' % (qn(f.column), qn(f.column)) for f in key_fields]),
+            ', '.join(columns), ', '.join(['[source].%s' % c for c in columns]),
+            select_columns, qn(opts.db_table),
+            ' AND '.join(['[target].%s = %s' % (qn(f.column), p) for f, p in zip(key_fields, key_placeholders[0])]))
+
+        sql = self._with_identity_insert(opts, fields, sql)
+
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params + key_params)
+        row = cursor.fetchone()
+        transaction.commit_unless_managed(self.connection.alias)
+        obj = model(*row[1:])
+        obj._state.db = self.connection.alias
+        obj._state.adding = False
+        return obj, bool(row[0])
+
+    def collation(self, table=None, column=None):
+        """
+        Returns the collation of the given column, or of the database if no
+        column is given or the column has no collation (i.e. is not a
+        character column). Collations are looked up once per connection.
+        """
+        if not hasattr(self, '_collations'):
+            self._collations = dict()
+
+        key = (table, column)
+        if key not in self._collations:
+            cursor = self.connection.cursor()
+            collation = None
+            if table and column:
+                cursor.execute("SELECT collation_name FROM sys.columns WHERE object_id = OBJECT_ID(%s) AND name = %s",
+                    [self.quote_name(table), column])
+                row = cursor.fetchone()
+                if row:
+                    collation = row[0]
+            if collation is None:
+                if (None, None) not in self._collations:
+                    cursor.execute("SELECT CONVERT(nvarchar(128), DATABASEPROPERTYEX(DB_NAME(), 'Collation'))")
+                    self._collations[(None, None)] = cursor.fetchone()[0]
+                collation = self._collations[(None, None)]
+            self._collations[key] = collation
+        return self._collations[key]
+
+    def is_case_insensitive(self, table=None, column=None):
+        """Returns True if the collation of the column (or database) is case insensitive."""
+        collation = (self.collation(table, column) or '').upper()
+        return '_CI_' in collation or collation.endswith('_CI')
+
+    def fulltext_search_sql(self, field_name):
+        """
+        Returns the SQL WHERE clause to use for the __search lookup, which
+        needs a full-text index on the column.
+        """
+        return 'CONTAINS(%s, %%s)' % field_name
+
     def date_extract_sql(self, lookup_type, field_name):
         return "DATEPART(%s, %s)" % (lookup_type, self.quote_name(field_name))
 
@@ -22,14 +850,11 @@ class DatabaseOperations(BaseDatabaseOperations):
     def prep_for_like_query(self, x):
         """Prepares a value for use in a LIKE query."""
         from django.utils.encoding import smart_unicode
-        return (
-            smart_unicode(x).\
-                replace("\\", "\\\\").\
-                replace("%", "\%").\
-                replace("_", "\_").\
-                replace("[", "\[").\
-                replace("]", "\]")
-            )
+        return smart_unicode(x).translate(_like_escapes)
+
+    # iexact lookups on case sensitive collations still use LIKE, so they
+    # need the brackets escaped as well.
+    prep_for_iexact_query = prep_for_like_query
 
     def quote_name(self, name):
         if name.startswith('[') and name.endswith(']'):
@@ -66,10 +891,16 @@ class DatabaseOperations(BaseDatabaseOperations):
         cursor = connection.cursor()
         # Try to minimize the risks of the braindeaded inconsistency in
         # DBCC CHEKIDENT(table, RESEED, n) behavior.
+        # Whether each table has rows is checked exactly, with an EXISTS
+        # that stops at the first row, for all tables in one query.
+        has_rows = []
+        if sequences:
+            cursor.execute("SELECT %s" % ', '.join([
+                "CASE WHEN EXISTS (SELECT * FROM %s) THEN 1 ELSE 0 END" % qn(seq["table"])
+                for seq in sequences]))
+            has_rows = cursor.fetchone()
         seqs = []
-        for seq in sequences:
-            cursor.execute("SELECT COUNT(*) FROM %s" % qn(seq["table"]))
-            rowcnt = cursor.fetchone()[0]
+        for seq, rowcnt in zip(sequences, has_rows):
             elem = dict()
 
             if rowcnt:
@@ -147,7 +978,9 @@ class DatabaseOperations(BaseDatabaseOperations):
     def year_lookup_bounds(self, value):
         """
         Returns a two-elements list with the lower and upper bound to be used
-        with a BETWEEN operator to query a field value using a year lookup
+        with a BETWEEN operator to query a field value using a year lookup.
+        The compiler turns the year lookups of where clauses into a half-open
+        range instead (see where.DateRangeNode).
 
         `value` is an int, containing the looked-up year.
         """
@@ -0,0 +1,274 @@
+"""Paginators that take advantage of SQL Server specific query patterns."""
+from django.core.paginator import Paginator, Page, EmptyPage, PageNotAnInteger
+from django.db.models import Q
+
+from queryset import approximate_count
+
+__all__ = (
+    'ApproximateCountPaginator',
+    'CountOverPaginator',
+    'KeysetPage',
+    'KeysetPaginator',
+    'fetch_with_count',
+    'keyset_filter',
+)
+
+def _split_ordering(ordering):
+    """Return a list of (field_name, descending) tuples for an ordering."""
+    parts = []
+    for name in ordering:
+        if name.startswith('-'):
+            parts.append((name[1:], True))
+        else:
+            parts.append((name.lstrip('+'), False))
+    return parts
+
+def keyset_filter(ordering, last_key):
+    """
+    Return a Q object that matches the rows sorting after ``last_key``.
+
+    SQL Server does not support row value comparisons, so the seek predicate
+    ``(a, b) > (x, y)`` is expanded to::
+
+        a >= x AND (a > x OR (a = x AND b > y))
+
+    The leading range on the first ordering column lets the optimizer seek
+    an index on the ordering columns instead of numbering and discarding
+    every row before the page. Descending columns use the reversed
+    comparison. The ordering columns must not contain NULLs.
+    """
+    columns = _split_ordering(ordering)
+    if len(columns) != len(last_key):
+        raise ValueError("The keyset must have one value per ordering column.")
+
+    def _op(descending, inclusive=False):
+        op = descending and 'lt' or 'gt'
+        if inclusive:
+            op += 'e'
+        return op
+
+    first_name, first_desc = columns[0]
+    leading = Q(**{'%s__%s' % (first_name, _op(first_desc, True)): last_key[0]})
+
+    after = None
+    for i, (name, descending) in enumerate(columns):
+        term = dict([(columns[j][0], last_key[j]) for j in xrange(i)])
+        term['%s__%s' % (name, _op(descending))] = last_key[i]
+        if after is None:
+            after = Q(**term)
+        else:
+            after |= Q(**term)
+
+    if len(columns) == 1:
+        return after
+    return leading & after
+
+
+class KeysetPage(Page):
+    """
+    A page fetched by seeking past the key of the previous page.
+
+    ``next_key`` is the key of the last row on the page and can be handed to
+    ``KeysetPaginator.page_after`` (or ``page(number + 1, after=...)``) to
+    fetch the following page.
+    """
+    def __init__(self, object_list, number, paginator, next_key=None, more=None):
+        super(KeysetPage, self).__init__(object_list, number, paginator)
+        self.next_key = next_key
+        self._more = more
+
+    def __repr__(self):
+        if self.number is None:
+            return '<KeysetPage ending at %r>' % (self.next_key,)
+        return super(KeysetPage, self).__repr__()
+
+    def has_next(self):
+        if self._more is not None:
+            return self._more
+        return super(KeysetPage, self).has_next()
+
+    def has_previous(self):
+        if self.number is None:
+            return True
+        return super(KeysetPage, self).has_previous()
+
+
+class KeysetPaginator(Paginator):
+    """
+    A Paginator that fetches pages with index seeks instead of ROW_NUMBER().
+
+    Sliced querysets with an offset are rewritten by the compiler to number
+    every row before the requested page, which makes deep pages slow. This
+    paginator remembers the key of the last row of each page it serves and
+    fetches the following page with ``keyset_filter`` and ``TOP (n)``.
+
+    ``ordering`` should name indexed columns. If none of them are unique the
+    primary key is appended so that the key of a row is unique. When the key
+    of the previous page is unknown, ``page()`` falls back to the regular
+    offset query. Pass the ``next_key`` of a page back as ``after`` to keep
+    seeking across requests, or use ``page_after()`` for infinite scrolling
+    without a COUNT query.
+    """
+    def __init__(self, object_list, per_page, ordering=None, orphans=0, allow_empty_first_page=True):
+        super(KeysetPaginator, self).__init__(object_list, per_page, orphans, allow_empty_first_page)
+        opts = object_list.model._meta
+        if ordering is None:
+            ordering = object_list.query.order_by or opts.ordering
+        ordering = list(ordering)
+        if not ordering:
+            ordering = ['pk']
+
+        self._fields = []
+        unique = False
+        for name, descending in _split_ordering(ordering):
+            field = self._get_field(opts, name)
+            unique = unique or field.primary_key or field.unique
+            self._fields.append(field)
+        if not unique:
+            ordering.append('pk')
+            self._fields.append(opts.pk)
+
+        self.ordering = ordering
+        self.object_list = object_list.order_by(*ordering)
+        self._keys = {}
+
+    def _get_field(self, opts, name):
+        if name == 'pk':
+            return opts.pk
+        if '__' in name:
+            raise ValueError("Keyset ordering only supports local fields: %s" % name)
+        return opts.get_field(name)
+
+    def get_key(self, obj):
+        """Return the keyset tuple for the given model instance."""
+        return tuple([getattr(obj, f.attname) for f in self._fields])
+
+    def _fetch(self, after, count):
+        qs = self.object_list
+        if after is not None:
+            qs = qs.filter(keyset_filter(self.ordering, after))
+        return list(qs[:count])
+
+    def page(self, number, after=None):
+        """
+        Return a Page object for the given 1-based page number.
+
+        ``after`` is the key of the last row on the previous page. If it is
+        not given and that page has not been served by this paginator, the
+        page is fetched with an offset query.
+        """
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        top = bottom + self.per_page
+        if top + self.orphans >= self.count:
+            top = self.count
+
+        if after is None:
+            after = self._keys.get(number - 1)
+
+        if number == 1:
+            object_list = self._fetch(None, top)
+        elif after is not None:
+            object_list = self._fetch(after, top - bottom)
+        else:
+            object_list = list(self.object_list[bottom:top])
+
+        next_key = None
+        if object_list:
+            next_key = self.get_key(object_list[-1])
+            self._keys[number] = next_key
+        return KeysetPage(object_list, number, self, next_key)
+
+    def page_after(self, after=None):
+        """
+        Return the page of rows following the key ``after``.
+
+        No COUNT query is issued; ``has_next()`` is answered by fetching one
+        extra row. The returned page has no page number.
+        """
+        rows = self._fetch(after, self.per_page + 1)
+        more = len(rows) > self.per_page
+        object_list = rows[:self.per_page]
+        next_key = None
+        if object_list:
+            next_key = self.get_key(object_list[-1])
+        number = after is None and 1 or None
+        return KeysetPage(object_list, number, self, next_key, more)
+
+
+def fetch_with_count(queryset):
+    """
+    Evaluate a (usually sliced) queryset and count all of its matching rows
+    in the same query.
+
+    The compiler adds ``COUNT(*) OVER()`` to the select list and strips it
+    from each row. Returns a tuple of (rows, total). The total is None when
+    it could not be determined, i.e. for an empty page or a DISTINCT query.
+    """
+    qs = queryset._clone()
+    qs.query.with_total_count = True
+    rows = list(qs)
+    return rows, getattr(qs.query, 'total_count', None)
+
+
+class CountOverPaginator(Paginator):
+    """
+    A Paginator that fetches a page and the total count in one round trip.
+
+    The default Paginator issues a COUNT(*) query before the page query,
+    evaluating the filter twice. This paginator fetches the page first with
+    ``fetch_with_count`` and only falls back to a separate count query when
+    the window count is unavailable.
+    """
+    def page(self, number):
+        "Returns a Page object for the given 1-based page number."
+        try:
+            number = int(number)
+        except ValueError:
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+
+        bottom = (number - 1) * self.per_page
+        object_list = None
+        if self._count is None and hasattr(self.object_list, 'query'):
+            # Fetch the orphans as well so the last page can be completed
+            # without knowing the count up front.
+            top = bottom + self.per_page + self.orphans
+            object_list, total = fetch_with_count(self.object_list[bottom:top])
+            if total is not None:
+                self._count = total
+            elif not bottom and not object_list:
+                self._count = 0
+
+        number = self.validate_number(number)
+        top = bottom + self.per_page
+        if top + self.orphans >= self.count:
+            top = self.count
+
+        if object_list is None:
+            object_list = self.object_list[bottom:top]
+        else:
+            object_list = object_list[:top - bottom]
+        return Page(object_list, number, self)
+
+
+class ApproximateCountPaginator(Paginator):
+    """
+    A Paginator that counts unfiltered querysets from the table statistics.
+
+    An exact COUNT(*) of a very large table can take longer than the page
+    query itself, e.g. for an admin changelist. Use this class as the
+    ModelAdmin.paginator to count unfiltered changelists with
+    approximate_count(). Filtered querysets and tables estimated to have
+    fewer than `exact_threshold` rows are counted exactly. After counting,
+    `exact` tells whether the count is exact.
+    """
+    exact_threshold = 10000
+
+    def _get_count(self):
+        "Returns the total number of objects, across all pages."
+        if self._count is None and hasattr(self.object_list, 'query'):
+            self._count, self.exact = approximate_count(self.object_list, self.exact_threshold)
+        return super(ApproximateCountPaginator, self)._get_count()
+    count = property(_get_count)
@@ -0,0 +1,153 @@
+"""Scan a queryset in primary key ranges on several connections at once."""
+import Queue
+import sys
+import threading
+
+import pythoncom
+from django.db import connections
+
+__all__ = (
+    'parallel_scan',
+)
+
+# Put in the queue of a range after its last chunk of rows.
+_done = object()
+
+class _Failure(object):
+    """The exception raised while reading a range, re-raised by the reader."""
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+def _put(queue, item, stop):
+    """Put an item in the queue, giving up once ``stop`` is set."""
+    while not stop.isSet():
+        try:
+            queue.put(item, True, 0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def _scan_ranges(using, pending, outputs, stop, chunk_size):
+    """
+    Read ranges from the ``pending`` queue until it is empty, putting the
+    rows of each range in chunks in its output queue.
+
+    The thread initializes COM for itself and reads on its own connection,
+    as DatabaseWrapper connections are local to the thread; the connection
+    is closed when the thread is done.
+    """
+    pythoncom.CoInitialize()
+    try:
+        while not stop.isSet():
+            try:
+                index, queryset = pending.get_nowait()
+            except Queue.Empty:
+                break
+            output = outputs[index]
+            try:
+                chunk = []
+                for row in queryset.iterator():
+                    chunk.append(row)
+                    if len(chunk) >= chunk_size:
+                        if not _put(output, chunk, stop):
+                            return
+                        chunk = []
+                if chunk and not _put(output, chunk, stop):
+                    return
+            except Exception:
+                if not _put(output, _Failure(sys.exc_info()), stop):
+                    return
+            if not _put(output, _done, stop):
+                return
+    finally:
+        try:
+            connections[using].close()
+        finally:
+            pythoncom.CoUninitialize()
+
+def parallel_scan(queryset, workers=4, ordered=False, partitions=None, chunk_size=500):
+    """
+    Return an iterator of the rows of the queryset, read by ``workers``
+    threads that each run the query for a range of primary keys on their
+    own connection.
+
+    The queryset is split into ``partitions`` (by default ``workers``)
+    primary key ranges with DatabaseOperations.key_boundaries(), so each
+    range reads about the same number of rows, and the threads take the
+    ranges in key order. Rows are handed over in chunks of ``chunk_size``
+    and at most a few chunks per range are buffered, so a slow reader
+    holds the threads back instead of the rows piling up in memory.
+
+    Without ``ordered`` the rows are returned as they arrive, in no
+    particular order. With ``ordered`` they are returned in primary key
+    order: each range is read ordered by primary key and the ranges are
+    returned one after another. Any ordering of the queryset is replaced.
+
+    Each thread reads outside of the transaction of the calling thread, so
+    rows written by that transaction are not seen (and may block the read
+    until the transaction ends). An error reading a range is raised when
+    the reader reaches that range, or in unordered mode, when it arrives.
+    Closing the iterator early stops the threads after their current
+    chunk.
+    """
+    query = queryset.query
+    if query.low_mark or query.high_mark is not None:
+        raise ValueError("Cannot scan a sliced queryset in parallel.")
+    if workers < 1:
+        raise ValueError("parallel_scan() needs at least one worker.")
+    if partitions is None:
+        partitions = workers
+
+    using = queryset.db
+    pk = queryset.model._meta.pk.name
+    if ordered:
+        queryset = queryset.order_by(pk)
+    else:
+        queryset = queryset.order_by()
+
+    boundaries = connections[using].ops.key_boundaries(queryset.model, partitions)
+    pending = Queue.Queue()
+    for index, (low, high) in enumerate(zip([None] + boundaries, boundaries + [None])):
+        qs = queryset
+        if low is not None:
+            qs = qs.filter(**{'%s__gt' % pk: low})
+        if high is not None:
+            qs = qs.filter(**{'%s__lte' % pk: high})
+        pending.put((index, qs))
+    return _merge(using, pending, len(boundaries) + 1, workers, ordered, chunk_size)
+
+def _merge(using, pending, count, workers, ordered, chunk_size):
+    """Start the threads and yield the rows they read."""
+    if ordered:
+        outputs = [Queue.Queue(2) for i in xrange(count)]
+    else:
+        outputs = [Queue.Queue(2 * workers)] * count
+    stop = threading.Event()
+    threads = []
+    for i in xrange(min(workers, count)):
+        thread = threading.Thread(target=_scan_ranges, args=(using, pending, outputs, stop, chunk_size))
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+
+    try:
+        if ordered:
+            sources = [(output, 1) for output in outputs]
+        else:
+            sources = [(outputs[0], count)]
+        for output, ranges in sources:
+            while ranges:
+                item = output.get()
+                if item is _done:
+                    ranges -= 1
+                elif isinstance(item, _Failure):
+                    exc_type, exc_value, tb = item.exc_info
+                    raise exc_type, exc_value, tb
+                else:
+                    for row in item:
+                        yield row
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,179 @@
+"""A cache of compiled SELECT statements for queries of the same shape."""
+
+__all__ = (
+    'QueryTemplateCache',
+)
+
+# Stands in for the WHERE clause in a cached statement.
+WHERE_PLACEHOLDER = '__sqlserver_where__'
+
+def _freeze(value):
+    """Return a hashable copy of a structure of dicts, lists and sets."""
+    if isinstance(value, dict):
+        return tuple(sorted([(k, _freeze(v)) for k, v in value.items()]))
+    if isinstance(value, (list, tuple)):
+        return tuple([_freeze(v) for v in value])
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    return value
+
+
+def _split_whitespace(sql):
+    """Return the leading whitespace, the text and the trailing whitespace."""
+    text = sql.strip()
+    if not text:
+        return sql, '', ''
+    start = sql.index(text)
+    return sql[:start], text, sql[start + len(text):]
+
+
+class _PlaceholderWhere(object):
+    """
+    A where node that compiles to the WHERE clause placeholder, surrounded by
+    the same whitespace as the WHERE clause, so the statement is rewritten
+    exactly as it would be with the WHERE clause itself.
+    """
+    def __init__(self, where_sql):
+        self.where_sql = where_sql
+
+    def as_sql(self, qn=None, connection=None):
+        lead, text, trail = _split_whitespace(self.where_sql)
+        if text:
+            return lead + WHERE_PLACEHOLDER + trail, []
+        return self.where_sql, []
+
+
+class QueryTemplateCache(object):
+    """
+    A cache of compiled SELECT statements keyed by the shape of the query.
+
+    Querysets of the same shape (model, joins, selected columns, extra
+    selects, ordering, slicing and select_related) compile to the same SQL
+    except for the WHERE clause. The WHERE clause and its parameters are
+    compiled for every execution and spliced into the cached statement,
+    which skips the column, join and ordering compilation and the slicing
+    rewrite. Queries with aggregates, grouping or custom select expressions
+    are always compiled.
+
+    Enable the cache with the 'query_template_cache' database OPTIONS entry,
+    set to True or to the maximum number of cached statements. The cache is
+    emptied when it is full.
+    """
+    default_max_size = 500
+
+    # Query attributes, besides the django ones, that change the compiled SQL.
+    query_attributes = (
+        'with_total_count',
+        'select_for_update',
+        'select_for_update_nowait',
+        'select_for_update_skip_locked',
+        'table_hints',
+        'table_sample',
+    )
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or self.default_max_size
+        self.templates = dict()
+        self.hits = self.misses = self.uncacheable = 0
+
+    def clear(self):
+        """Remove all cached statements and reset the statistics."""
+        self.templates.clear()
+        self.hits = self.misses = self.uncacheable = 0
+
+    def stats(self):
+        """Return a dictionary of the cache hit and miss statistics."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'uncacheable': self.uncacheable,
+            'size': len(self.templates),
+        }
+
+    def make_key(self, query, with_limits, with_col_aliases):
+        """
+        Return the structural fingerprint of the query, or None if the query
+        cannot be cached.
+        """
+        if query.aggregate_select or query.group_by is not None or query.having.children:
+            return None
+        if getattr(query, 'fulltext_rank', None):
+            # The search terms are a parameter of the FROM clause.
+            return None
+        for col in query.select:
+            if not isinstance(col, (list, tuple)):
+                return None
+
+        extra_select = tuple([(name, sql, len(params))
+            for name, (sql, params) in query.extra_select.iteritems()])
+
+        return (
+            query.model, with_limits, with_col_aliases,
+            _freeze(query.alias_map), tuple(query.tables),
+            _freeze(query.alias_refcount), _freeze(query.included_inherited_models),
+            query.default_cols, _freeze(query.select), tuple(query.select_fields),
+            _freeze(query.deferred_loading), extra_select,
+            tuple(query.extra_tables), tuple(query.extra_order_by),
+            tuple(query.order_by), query.default_ordering, query.standard_ordering,
+            query.distinct, query.low_mark, query.high_mark,
+            _freeze(query.select_related), query.max_depth,
+            tuple(query.related_select_cols),
+            tuple([getattr(query, name, None) for name in self.query_attributes]),
+        )
+
+    def as_sql(self, compiler, with_limits=True, with_col_aliases=False):
+        """Return the SQL and parameters for the query of the given compiler."""
+        query = compiler.query
+        key = self.make_key(query, with_limits, with_col_aliases)
+        if key is None:
+            self.uncacheable += 1
+            return compiler._as_sql(with_limits, with_col_aliases)
+
+        qn = compiler.quote_name_unless_alias
+        where_sql, where_params = query.where.as_sql(qn=qn, connection=compiler.connection)
+        where_sql = where_sql or ''
+        lead, where_text, trail = _split_whitespace(where_sql)
+        key += (bool(where_text), lead, trail)
+
+        entry = self.templates.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = self._compile(compiler, where_sql, with_limits, with_col_aliases)
+            if len(self.templates) >= self.max_size:
+                self.templates.clear()
+            self.templates[key] = entry
+        else:
+            self.hits += 1
+
+        template, params, query_state, compiler_state = entry
+        for name, value in query_state:
+            setattr(query, name, value[:])
+        for name, value in compiler_state:
+            setattr(compiler, name, value)
+
+        if not template:
+            return template, params
+
+        params = []
+        for sql, extra_params in query.extra_select.itervalues():
+            params.extend(extra_params)
+        params.extend(where_params)
+        return template.replace(WHERE_PLACEHOLDER, where_text), tuple(params)
+
+    def _compile(self, compiler, where_sql, with_limits, with_col_aliases):
+        """Compile the query with a placeholder for the WHERE clause."""
+        query = compiler.query
+        where = query.where
+        query.where = _PlaceholderWhere(where_sql)
+        try:
+            template, params = compiler._as_sql(with_limits, with_col_aliases)
+        finally:
+            query.where = where
+
+        # Compiling fills in the related selections and the ordering aliases,
+        # which are needed to read the results.
+        query_state = tuple([(name, getattr(query, name)[:]) for name in
+            ('related_select_cols', 'related_select_fields', 'ordering_aliases')])
+        compiler_state = tuple([(name, getattr(compiler, name, False))
+            for name in compiler.template_state])
+        return template, params, query_state, compiler_state
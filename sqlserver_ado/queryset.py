@@ -0,0 +1,382 @@
+"""QuerySet and Manager classes exposing SQL Server specific query features."""
+from django.db import connections, router, transaction
+from django.db.models import Manager
+from django.db.models.query import QuerySet
+from django.db.models.sql import UpdateQuery
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.db.models.sql.query import Query
+from django.db.models.sql.where import AND
+
+from where import FullTextNode
+
+__all__ = (
+    'SqlServerManager',
+    'SqlServerQuery',
+    'SqlServerQuerySet',
+    'approximate_count',
+)
+
+def approximate_count(queryset, exact_threshold=None):
+    """
+    Return a tuple of (row_count, is_exact) for the given queryset.
+
+    Unfiltered querysets are counted from the table statistics with
+    DatabaseOperations.approximate_count, instead of a COUNT(*) scan of the
+    whole table. Any other queryset is counted exactly.
+    """
+    query = queryset.query
+    ops = connections[queryset.db].ops
+    unfiltered = not (query.where.children or query.having.children or
+        query.distinct or query.low_mark or query.high_mark is not None)
+    if unfiltered and hasattr(ops, 'approximate_count'):
+        return ops.approximate_count(queryset.model, exact_threshold)
+    return queryset.count(), True
+
+
+class SqlServerQuery(Query):
+    """
+    A Query that keeps the SQL Server specific options set by
+    SqlServerQuerySet methods when it is cloned.
+    """
+    clone_attributes = (
+        'fulltext_rank',
+        'select_for_update',
+        'select_for_update_nowait',
+        'select_for_update_skip_locked',
+        'query_hints',
+        'table_hints',
+        'table_sample',
+    )
+
+    def clone(self, klass=None, memo=None, **kwargs):
+        obj = super(SqlServerQuery, self).clone(klass, memo, **kwargs)
+        for name in self.clone_attributes:
+            if name in self.__dict__ and name not in kwargs:
+                obj.__dict__[name] = self.__dict__[name]
+        return obj
+
+
+class SqlServerQuerySet(QuerySet):
+    """A QuerySet with methods for SQL Server specific query features."""
+    def __init__(self, model=None, query=None, using=None):
+        super(SqlServerQuerySet, self).__init__(model, query or SqlServerQuery(model), using)
+
+    def approximate_count(self, exact_threshold=None):
+        """
+        Return a tuple of (row_count, is_exact). See approximate_count().
+        """
+        return approximate_count(self, exact_threshold)
+
+    def select_for_update(self, nowait=False, skip_locked=False):
+        """
+        Lock the selected rows until the end of the transaction, with
+        WITH (UPDLOCK, ROWLOCK) hints on the tables of the query.
+
+        With ``skip_locked`` rows locked by other transactions are skipped
+        (READPAST), and with ``nowait`` a locked row raises a DatabaseError
+        instead of waiting (NOWAIT). The locks are released at the end of
+        the transaction, so use this inside a managed transaction.
+        """
+        if nowait and skip_locked:
+            raise ValueError("The nowait option cannot be used with skip_locked.")
+        clone = self._clone()
+        clone.query.select_for_update = True
+        clone.query.select_for_update_nowait = nowait
+        clone.query.select_for_update_skip_locked = skip_locked
+        return clone
+
+    def query_hints(self, maxdop=None, recompile=False, optimize_for_unknown=False, fast=None):
+        """
+        Add an OPTION clause with the given query hints, replacing any
+        query hints set before:
+
+        ``maxdop``: limit the parallelism of the plan to n processors.
+        ``recompile``: compile a new plan for every execution, for the
+        actual parameter values.
+        ``optimize_for_unknown``: optimize for the average distribution of
+        the parameters instead of the values the plan is first compiled for.
+        ``fast``: optimize for returning the first n rows quickly.
+        """
+        hints = []
+        if maxdop is not None:
+            hints.append('MAXDOP %d' % maxdop)
+        if recompile:
+            hints.append('RECOMPILE')
+        if optimize_for_unknown:
+            hints.append('OPTIMIZE FOR UNKNOWN')
+        if fast is not None:
+            hints.append('FAST %d' % fast)
+        clone = self._clone()
+        clone.query.query_hints = tuple(hints)
+        return clone
+
+    def table_hints(self, hints, model=None):
+        """
+        Add table hints, e.g. 'NOLOCK', 'FORCESEEK' or 'INDEX(ix_name)', to
+        the table of ``model`` (by default the model of the queryset)
+        wherever it appears in the FROM clause. ``hints`` is a hint or a
+        list of hints, and replaces any hints given before for the table.
+        """
+        if isinstance(hints, basestring):
+            hints = [hints]
+        table = (model or self.model)._meta.db_table
+        table_hints = dict(getattr(self.query, 'table_hints', None) or ())
+        table_hints[table] = tuple(hints)
+        clone = self._clone()
+        clone.query.table_hints = tuple(sorted(table_hints.items()))
+        return clone
+
+    def tree(self, parent_field, max_depth=None, ancestors=False):
+        """
+        Return the rows with all their descendants, or ancestors, in one
+        query. See DatabaseOperations.tree_query().
+        """
+        return connections[self.db].ops.tree_query(self, parent_field, max_depth, ancestors)
+
+    def update_returning(self, fields, **kwargs):
+        """
+        Update the rows like update(), and return the new values of the
+        given fields of the updated rows as a list of dictionaries.
+
+        The values are read with OUTPUT INSERTED in the UPDATE statement
+        itself, so e.g. the new value of a counter incremented with F()
+        needs no second query and cannot be changed in between. SQL Server
+        does not allow OUTPUT on tables with triggers.
+        """
+        assert self.query.can_filter(), \
+                "Cannot update a query once a slice has been taken."
+        opts = self.model._meta
+        names = list(fields)
+        columns = [(name == 'pk' and opts.pk or opts.get_field(name)).column for name in names]
+        self._for_write = True
+        query = self.query.clone(UpdateQuery)
+        query.add_update_values(kwargs)
+        if query.related_updates:
+            raise ValueError("update_returning() can only update the fields of the model's own table.")
+        query.returning = columns
+        try:
+            sql, params = query.get_compiler(self.db).as_sql()
+        except EmptyResultSet:
+            return []
+        if not sql:
+            return []
+        cursor = connections[self.db].cursor()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        transaction.commit_unless_managed(using=self.db)
+        return [dict(zip(names, row)) for row in rows]
+
+    def update_get(self, fields, **kwargs):
+        """
+        Update the single row matched by the queryset and return its new
+        values, e.g. for a counter:
+
+            n = Counter.objects.filter(pk=1).update_get('n', n=F('n') + 1)
+
+        ``fields`` is a field name, whose value is returned, or a list of
+        names, whose values are returned as a tuple. Returns None if no row
+        matched. Raises MultipleObjectsReturned if more than one row was
+        updated; the updates are not undone.
+        """
+        if isinstance(fields, basestring):
+            names = [fields]
+        else:
+            names = list(fields)
+        rows = self.update_returning(names, **kwargs)
+        if not rows:
+            return None
+        if len(rows) > 1:
+            raise self.model.MultipleObjectsReturned("update_get() updated %s %s rows." % (
+                len(rows), self.model._meta.object_name))
+        if isinstance(fields, basestring):
+            return rows[0][fields]
+        return tuple([rows[0][name] for name in names])
+
+    def tablesample(self, percent, seed=None):
+        """
+        Read only a random ``percent`` of the pages of the model's table,
+        with TABLESAMPLE SYSTEM. Pass a ``seed`` to get the same sample
+        again while the table is unchanged.
+        """
+        clone = self._clone()
+        clone.query.table_sample = (percent, seed)
+        return clone
+
+    def sample(self, n, oversample=2.0, spread=1):
+        """
+        Return a list of up to ``n`` random rows of the queryset.
+
+        order_by('?') sorts every matching row by NEWID(). Instead, this
+        reads about ``oversample`` times the needed number of rows with
+        tablesample(), based on the approximate row count of the table,
+        and picks n of them at random. When the sample holds fewer than n
+        matching rows the percentage is raised, up to reading the whole
+        table.
+
+        TABLESAMPLE picks whole pages, so rows stored together tend to be
+        sampled together. With ``spread`` > 1 that many times more pages
+        are read and each row is kept with a probability of 1 / spread,
+        using CHECKSUM(NEWID()), which mixes rows from more pages.
+        """
+        ops = connections[self.db].ops
+        rows = ops.approximate_count(self.model)[0]
+        percent = 100.0 * n * oversample * spread / max(rows, 1)
+        qs = self
+        if spread > 1:
+            pk = '%s.%s' % (ops.quote_name(self.model._meta.db_table),
+                ops.quote_name(self.model._meta.pk.column))
+            qs = qs.extra(where=['CAST(CHECKSUM(NEWID(), %s) & 0x7fffffff AS float) '
+                '/ 2147483647 < %r' % (pk, 1.0 / spread)])
+        while percent < 100:
+            objs = list(qs.tablesample(percent).order_by('?')[:n])
+            if len(objs) >= n:
+                return objs
+            percent *= 4
+        return list(self.order_by('?')[:n])
+
+    def json(self, *fields, **kwargs):
+        """
+        Return an iterator of the chunks of a JSON array of the rows, built
+        by the server, with the given fields like values(*fields). The
+        ``chunk_size`` and ``encoding`` keyword arguments are passed on to
+        DatabaseOperations.json_chunks(), which also accepts any values()
+        queryset.
+        """
+        return connections[self.db].ops.json_chunks(self.values(*fields), **kwargs)
+
+    def parallel_scan(self, workers=4, ordered=False, partitions=None, chunk_size=500):
+        """
+        Return an iterator of the rows, read in primary key ranges by several
+        threads on their own connections. See parallel.parallel_scan().
+        """
+        from parallel import parallel_scan
+        return parallel_scan(self, workers, ordered, partitions, chunk_size)
+
+    def purge(self, archive=None, batch_size=5000, pause=0, progress=None):
+        """
+        Delete the rows in committed batches, optionally archiving them.
+        See DatabaseOperations.purge().
+        """
+        return connections[self.db].ops.purge(self, archive, batch_size, pause, progress)
+
+    def _fulltext_columns(self, fields):
+        if isinstance(fields, basestring):
+            fields = [fields]
+        return [self.model._meta.get_field(name).column for name in fields]
+
+    def _fulltext_filter(self, fields, terms, freetext):
+        clone = self._clone()
+        alias = clone.query.get_initial_alias()
+        columns = [(alias, column) for column in clone._fulltext_columns(fields)]
+        clone.query.where.add(FullTextNode(columns, terms, freetext), AND)
+        return clone
+
+    def ft_contains(self, fields, terms):
+        """
+        Filter with a CONTAINS full-text predicate, e.g. '"data*" NEAR base'.
+
+        ``fields`` is the name, or a list of names, of local fields with a
+        full-text index. Unlike __contains, which compiles to a LIKE pattern
+        that has to scan the column, this uses the full-text index.
+        """
+        return self._fulltext_filter(fields, terms, False)
+
+    def ft_freetext(self, fields, terms):
+        """
+        Filter with a FREETEXT predicate, which matches the meaning of the
+        words in ``terms`` rather than their exact wording.
+        """
+        return self._fulltext_filter(fields, terms, True)
+
+    def ranked_search(self, terms, fields='*', freetext=False, top_n=None, rank_name='rank'):
+        """
+        Return the rows matching a full-text search, best matches first.
+
+        The table is joined to CONTAINSTABLE (or FREETEXTTABLE if
+        ``freetext`` is set), and each row gets the rank of its match as an
+        attribute named ``rank_name``. ``fields`` defaults to all the
+        columns of the table's full-text index. ``top_n`` limits the search
+        to the best n matches, which is much faster for large result sets.
+        """
+        clone = self._clone()
+        if fields != '*':
+            fields = tuple(clone._fulltext_columns(fields))
+        clone.query.fulltext_rank = (fields, terms, freetext, top_n)
+        clone = clone.extra(select={rank_name: '[ft_rank].[RANK]'})
+        return clone.order_by('-%s' % rank_name)
+
+
+class SqlServerManager(Manager):
+    """A Manager that returns SqlServerQuerySet instances."""
+    def get_query_set(self):
+        return SqlServerQuerySet(self.model, using=self._db)
+
+    def approximate_count(self, *args, **kwargs):
+        return self.get_query_set().approximate_count(*args, **kwargs)
+
+    def bulk_insert(self, objs, batch_size=None):
+        """
+        Insert the model instances and set their generated primary keys.
+        See DatabaseOperations.bulk_insert().
+        """
+        using = self._db or router.db_for_write(self.model)
+        return connections[using].ops.bulk_insert(objs, batch_size)
+
+    def bulk_upsert(self, rows, key_fields, update_fields=None, batch_size=None, returning=False):
+        """
+        Insert or update rows matched by key_fields with MERGE.
+        See DatabaseOperations.bulk_upsert().
+        """
+        using = self._db or router.db_for_write(self.model)
+        return connections[using].ops.bulk_upsert(self.model, rows, key_fields,
+            update_fields, batch_size, returning)
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        """
+        Save the given fields of the model instances, one UPDATE per batch.
+        See DatabaseOperations.bulk_update().
+        """
+        using = self._db or router.db_for_write(self.model)
+        return connections[using].ops.bulk_update(objs, fields, batch_size)
+
+    def ft_contains(self, *args, **kwargs):
+        return self.get_query_set().ft_contains(*args, **kwargs)
+
+    def ft_freetext(self, *args, **kwargs):
+        return self.get_query_set().ft_freetext(*args, **kwargs)
+
+    def json(self, *args, **kwargs):
+        return self.get_query_set().json(*args, **kwargs)
+
+    def parallel_scan(self, *args, **kwargs):
+        return self.get_query_set().parallel_scan(*args, **kwargs)
+
+    def purge(self, *args, **kwargs):
+        return self.get_query_set().purge(*args, **kwargs)
+
+    def query_hints(self, *args, **kwargs):
+        return self.get_query_set().query_hints(*args, **kwargs)
+
+    def ranked_search(self, *args, **kwargs):
+        return self.get_query_set().ranked_search(*args, **kwargs)
+
+    def sample(self, *args, **kwargs):
+        return self.get_query_set().sample(*args, **kwargs)
+
+    def select_for_update(self, *args, **kwargs):
+        return self.get_query_set().select_for_update(*args, **kwargs)
+
+    def table_hints(self, *args, **kwargs):
+        return self.get_query_set().table_hints(*args, **kwargs)
+
+    def tablesample(self, *args, **kwargs):
+        return self.get_query_set().tablesample(*args, **kwargs)
+
+    def tree(self, *args, **kwargs):
+        return self.get_query_set().tree(*args, **kwargs)
+
+    def update_get(self, *args, **kwargs):
+        return self.get_query_set().update_get(*args, **kwargs)
+
+    def update_returning(self, *args, **kwargs):
+        return self.get_query_set().update_returning(*args, **kwargs)
@@ -0,0 +1,304 @@
+"""
+Translation of regular expressions into LIKE patterns.
+
+__regex and __iregex lookups call the dbo.REGEXP_LIKE CLR function for
+every row, and cannot use an index. Many of the regular expressions used
+in lookups, such as anchored prefixes, alternations of literals and simple
+character classes, can be expressed as one or more LIKE patterns instead.
+
+The patterns follow the options that REGEXP_LIKE uses: unescaped white
+space in the expression is ignored and "." matches any character.
+"""
+import re
+
+__all__ = (
+    'MAX_PATTERNS',
+    'regex_to_like',
+)
+
+# Maximum number of LIKE patterns a regular expression is expanded into.
+MAX_PATTERNS = 8
+
+# Characters that have a special meaning in a LIKE pattern.
+_like_special = u'\\%_[]'
+
+# Characters that cannot be used as literals in a LIKE character class.
+_class_special = u'\\[]^-'
+
+# Character ranges that are also ranges in the sort order of any collation.
+_range_groups = (u'0123456789', u'abcdefghijklmnopqrstuvwxyz', u'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+
+_escapes = {u'n': u'\n', u'r': u'\r', u't': u'\t', u'f': u'\f', u'v': u'\v', u'e': u'\x1b'}
+
+_re_repeat = re.compile(r'\{(\d+)(,(\d*))?\}')
+
+# Anchors, which are only allowed at the start or end of an alternative.
+_START, _END, _END_NEWLINE = object(), object(), object()
+_anchors = (_START, _END, _END_NEWLINE)
+
+class _Untranslatable(Exception):
+    pass
+
+def _literal(ch):
+    if ch in _like_special:
+        return u'\\' + ch
+    return ch
+
+
+class _Parser(object):
+    """
+    A recursive descent parser that expands a regular expression into a
+    list of alternatives, each a list of LIKE pattern fragments.
+
+    ``exact`` is cleared when a construct is replaced by a wildcard that
+    matches more than the construct, and ``ranges`` is set when a character
+    class with a range is used, as LIKE ranges follow the collation order.
+    """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.pos = 0
+        self.exact = True
+        self.ranges = False
+
+    def parse(self):
+        alternatives = self._alternation()
+        if self.pos != len(self.pattern):
+            # An unbalanced ")"
+            raise _Untranslatable
+        return alternatives
+
+    def _peek(self):
+        if self.pos < len(self.pattern):
+            return self.pattern[self.pos]
+        return None
+
+    def _next(self):
+        ch = self._peek()
+        if ch is None:
+            raise _Untranslatable
+        self.pos += 1
+        return ch
+
+    def _check(self, alternatives):
+        if len(alternatives) > MAX_PATTERNS:
+            raise _Untranslatable
+        return alternatives
+
+    def _alternation(self):
+        alternatives = self._sequence()
+        while self._peek() == u'|':
+            self.pos += 1
+            alternatives = self._check(alternatives + self._sequence())
+        return alternatives
+
+    def _sequence(self):
+        alternatives = [[]]
+        while self._peek() not in (None, u'|', u')'):
+            atom = self._atom()
+            if atom is None:
+                continue
+            atom = self._quantified(atom)
+            alternatives = self._check([a + b for a in alternatives for b in atom])
+        return alternatives
+
+    def _atom(self):
+        ch = self._next()
+        if ch.isspace():
+            return None
+        if ch == u'#':
+            # A comment
+            raise _Untranslatable
+        if ch == u'^':
+            return [[_START]]
+        if ch == u'$':
+            return [[_END_NEWLINE]]
+        if ch == u'.':
+            return [[u'_']]
+        if ch == u'[':
+            return [[self._class()]]
+        if ch == u'\\':
+            return [[self._escape()]]
+        if ch == u'(':
+            if self._peek() == u'?':
+                # Only non-capturing groups; no lookarounds or options.
+                if self.pattern[self.pos:self.pos + 2] != u'?:':
+                    raise _Untranslatable
+                self.pos += 2
+            alternatives = self._alternation()
+            if self._next() != u')':
+                raise _Untranslatable
+            return alternatives
+        if ch in u'*+?{':
+            raise _Untranslatable
+        return [[_literal(ch)]]
+
+    def _escape(self):
+        ch = self._next()
+        if ch == u'A':
+            return _START
+        if ch == u'z':
+            return _END
+        if ch == u'Z':
+            return _END_NEWLINE
+        if ch in _escapes:
+            return _literal(_escapes[ch])
+        if ch in u'dDwWsS':
+            # Unicode aware classes; match any character and filter with
+            # the regular expression.
+            self.exact = False
+            return u'_'
+        if ch.isalnum():
+            # Word boundaries, back references, code points, categories...
+            raise _Untranslatable
+        return _literal(ch)
+
+    def _class(self):
+        items = []
+        negated = self._peek() == u'^'
+        if negated:
+            self.pos += 1
+        while True:
+            ch = self._next()
+            if ch == u']' and items:
+                break
+            if ch == u'\\':
+                ch = self._next()
+                if ch in _escapes:
+                    ch = _escapes[ch]
+                elif ch.isalnum():
+                    raise _Untranslatable
+            elif ch == u'[':
+                # Class subtraction
+                raise _Untranslatable
+            if self._peek() == u'-' and self.pattern[self.pos + 1:self.pos + 2] not in (u']', u''):
+                self.pos += 1
+                end = self._next()
+                if end in u'\\[':
+                    raise _Untranslatable
+                items.append((ch, end))
+            else:
+                items.append((ch, None))
+
+        chars = []
+        for start, end in items:
+            if negated or not self._valid_class_item(start, end):
+                # LIKE has no escapes in character classes, and a negated
+                # class excludes more characters than the expression with a
+                # case or accent insensitive collation. Match any character
+                # and filter with the regular expression.
+                self.exact = False
+                return u'_'
+            if end is None:
+                chars.append(start)
+            else:
+                self.ranges = True
+                chars.append(u'%s-%s' % (start, end))
+        return u'[%s]' % u''.join(chars)
+
+    def _valid_class_item(self, start, end):
+        if end is None:
+            return start not in _class_special
+        for group in _range_groups:
+            if start in group and end in group:
+                return start <= end
+        return False
+
+    def _quantified(self, atom):
+        while self._peek() is not None and self._peek().isspace():
+            self.pos += 1
+        ch = self._peek()
+        if ch is None or ch not in u'*+?{':
+            return atom
+
+        if ch == u'{':
+            m = _re_repeat.match(self.pattern, self.pos)
+            if m is None:
+                raise _Untranslatable
+            self.pos = m.end()
+            minimum = int(m.group(1))
+            maximum = minimum
+            if m.group(2):
+                maximum = m.group(3) and int(m.group(3)) or None
+        else:
+            self.pos += 1
+            minimum, maximum = {u'*': (0, None), u'+': (1, None), u'?': (0, 1)}[ch]
+        if self._peek() == u'?':
+            # A lazy quantifier matches the same strings.
+            self.pos += 1
+
+        for alternative in atom:
+            for token in alternative:
+                if token in _anchors:
+                    raise _Untranslatable
+
+        if len(atom) ** minimum > MAX_PATTERNS:
+            raise _Untranslatable
+        if maximum is not None and maximum - minimum < MAX_PATTERNS:
+            counts = range(minimum, maximum + 1)
+        else:
+            counts = [minimum]
+            if atom != [[u'_']]:
+                self.exact = False
+
+        alternatives = []
+        for count in counts:
+            repeated = [[]]
+            for i in xrange(count):
+                repeated = [a + b for a in repeated for b in atom]
+            alternatives.extend(repeated)
+        if maximum is None or maximum - minimum >= MAX_PATTERNS:
+            alternatives = [a + [u'%'] for a in alternatives]
+        return self._check(alternatives)
+
+
+def regex_to_like(pattern):
+    """
+    Translate a regular expression into LIKE patterns (escaped with "\\").
+
+    Returns a tuple of (patterns, exact, ranges), or None if the expression
+    cannot be translated. A value matches the expression if it matches any
+    of the patterns, which are a superset of the expression if ``exact`` is
+    False. If ``ranges`` is True, the patterns have character ranges, which
+    are only exact for binary collations. The patterns are case sensitive
+    or not according to the collation of the column they are used with.
+    """
+    parser = _Parser(pattern)
+    try:
+        alternatives = parser.parse()
+    except _Untranslatable:
+        return None
+
+    patterns = []
+    for tokens in alternatives:
+        start = tokens[:1] == [_START]
+        if start:
+            tokens = tokens[1:]
+        end = None
+        if tokens and tokens[-1] in (_END, _END_NEWLINE):
+            end = tokens[-1]
+            tokens = tokens[:-1]
+        for token in tokens:
+            if token in _anchors:
+                return None
+        if not start:
+            tokens = [u'%'] + tokens
+        if end is None:
+            tokens = tokens + [u'%']
+
+        fragments = []
+        for token in tokens:
+            if token != u'%' or fragments[-1:] != [u'%']:
+                fragments.append(token)
+        like = u''.join(fragments)
+        if like not in patterns:
+            patterns.append(like)
+        if end is _END_NEWLINE and fragments[-1:] != [u'%'] and like + u'\n' not in patterns:
+            # "$" also matches before a final newline.
+            patterns.append(like + u'\n')
+
+    if len(patterns) > MAX_PATTERNS:
+        return None
+    if not parser.exact and not [p for p in patterns if p.strip(u'%_')]:
+        # Nothing to filter on before evaluating the expression.
+        return None
+    return patterns, parser.exact, parser.ranges
@@ -0,0 +1,107 @@
+"""Work queues stored in ordinary tables."""
+from django.db import connections, router, transaction
+
+__all__ = (
+    'TableQueue',
+)
+
+class TableQueue(object):
+    """
+    A work queue backed by the table of a model.
+
+    Each dequeue() takes up to ``count`` rows in a single statement that
+    reads the table WITH (UPDLOCK, ROWLOCK, READPAST), so concurrent
+    workers skip the rows claimed by each other instead of blocking, and
+    returns them as model instances.
+
+    Without a ``lease_field`` the claimed rows are deleted. With a
+    ``lease_field``, a nullable DateTimeField, the claimed rows are hidden
+    from other workers for ``lease_seconds`` by setting the field to the
+    time the lease expires. Rows must then be removed with complete(), or
+    they are handed out again once the lease expires.
+
+    Rows are taken in the order of ``ordering``, a field name optionally
+    prefixed by '-', which should be the leading column of an index. The
+    rows are returned with OUTPUT, which SQL Server does not allow on tables
+    with triggers.
+
+    Each call commits unless a transaction is managed, so claimed rows are
+    not handed out again once the worker's connection closes.
+    """
+    def __init__(self, model, lease_field=None, lease_seconds=300, ordering='pk', using=None):
+        opts = model._meta
+        if opts.parents:
+            raise ValueError("TableQueue does not support inherited models.")
+        self.model = model
+        self.lease_seconds = lease_seconds
+        self.using = using
+        self.descending = ordering.startswith('-')
+        self.order_field = self._get_field(ordering.lstrip('-'))
+        self.lease_field = None
+        if lease_field is not None:
+            self.lease_field = self._get_field(lease_field)
+
+    def _get_field(self, name):
+        opts = self.model._meta
+        if name == 'pk':
+            return opts.pk
+        return opts.get_field(name)
+
+    def _connection(self):
+        return connections[self.using or router.db_for_write(self.model)]
+
+    def enqueue(self, objs, batch_size=None):
+        """
+        Insert the model instances in batches, see
+        DatabaseOperations.bulk_insert(), and return them.
+        """
+        return self._connection().ops.bulk_insert(objs, batch_size)
+
+    def dequeue(self, count=1):
+        """
+        Claim up to ``count`` rows and return them as model instances, in
+        queue order. Returns an empty list when no row is available.
+        """
+        connection = self._connection()
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        order_column = qn(self.order_field.column)
+        batch = "WITH [batch] AS (SELECT TOP (%d) * FROM %s WITH (UPDLOCK, ROWLOCK, READPAST)%%s ORDER BY %s%s) " % (
+            count, qn(opts.db_table), order_column, self.descending and ' DESC' or '')
+
+        params = []
+        if self.lease_field is None:
+            sql = batch % '' + "DELETE FROM [batch] OUTPUT %s" % ', '.join(
+                ['DELETED.%s' % qn(f.column) for f in opts.fields])
+        else:
+            lease_column = qn(self.lease_field.column)
+            sql = batch % (' WHERE %s IS NULL OR %s < GETDATE()' % (lease_column, lease_column)) + \
+                "UPDATE [batch] SET %s = DATEADD(second, %%s, GETDATE()) OUTPUT %s" % (
+                lease_column, ', '.join(['INSERTED.%s' % qn(f.column) for f in opts.fields]))
+            params.append(self.lease_seconds)
+
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        transaction.commit_unless_managed(using=connection.alias)
+        objs = []
+        for row in rows:
+            obj = self.model(*row)
+            obj._state.db = connection.alias
+            obj._state.adding = False
+            objs.append(obj)
+        attname = self.order_field.attname
+        objs.sort(key=lambda obj: getattr(obj, attname), reverse=self.descending)
+        return objs
+
+    def complete(self, objs):
+        """Delete the rows of dequeued instances, once their work is done."""
+        self.model._default_manager.db_manager(self._connection().alias).filter(
+            pk__in=[obj.pk for obj in objs]).delete()
+
+    def release(self, objs):
+        """Return leased instances to the queue before their lease expires."""
+        if self.lease_field is None:
+            raise ValueError("Only leased rows can be released.")
+        self.model._default_manager.db_manager(self._connection().alias).filter(
+            pk__in=[obj.pk for obj in objs]).update(**{self.lease_field.attname: None})
@@ -0,0 +1,484 @@
+"""
+Rewrites of django where trees into forms that SQL Server can use indexes for.
+
+The compiler compiles the where tree of every query from a copy returned
+by rewrite_where(). Lookups that would wrap the column in a function are
+replaced, where equivalent, by nodes that compare the bare column, so the
+predicate stays sargable. The tree of the query itself is not changed.
+"""
+import copy
+import datetime
+import decimal
+import re
+
+from django.db.models.sql.where import AND, Constraint, WhereNode
+from django.utils import tree
+
+from regex import regex_to_like
+
+__all__ = (
+    'CaseInsensitiveNode',
+    'DateRangeNode',
+    'FullTextNode',
+    'LargeInNode',
+    'RegexNode',
+    'rewrite_where',
+)
+
+def _is_lookup(child):
+    """Return True if the where tree child is a (lvalue, lookup_type, annotation, value) leaf."""
+    return isinstance(child, (list, tuple)) and len(child) == 4
+
+def _is_column_lookup(child):
+    """Return True if the child is a lookup on a column, rather than e.g. an aggregate."""
+    return _is_lookup(child) and isinstance(child[0], (list, tuple, Constraint))
+
+def _column_key(lvalue):
+    """Return an (alias, column) tuple identifying the column of a lookup."""
+    if isinstance(lvalue, (list, tuple)):
+        return tuple(lvalue[:2])
+    return (lvalue.alias, lvalue.col)
+
+def _process(lvalue, lookup_type, value, connection):
+    """Return the column tuple and parameters for a lookup, like WhereNode.make_atom()."""
+    if hasattr(lvalue, 'process'):
+        return lvalue.process(lookup_type, value, connection)
+    return lvalue, [value]
+
+def _column_of(lvalue):
+    """Return the (table, column) of a lookup, or (None, None) if the field is unknown."""
+    field = getattr(lvalue, 'field', None)
+    if field is None:
+        return None, None
+    return field.model._meta.db_table, field.column
+
+def _start_of_year(year):
+    """Return the first moment of the year, or None past year 9999."""
+    if year > datetime.MAXYEAR:
+        return None
+    return datetime.datetime(year, 1, 1)
+
+def _relabel(lvalue, change_map):
+    """Relabel the table alias of a lookup's column, returning the lvalue."""
+    if isinstance(lvalue, (list, tuple)):
+        if lvalue[0] in change_map:
+            return (change_map[lvalue[0]],) + tuple(lvalue[1:])
+        return lvalue
+    lvalue.relabel_aliases(change_map)
+    return lvalue
+
+
+class DateRangeNode(object):
+    """
+    Matches the dates of a year, month or day of a date column with a
+    half-open range, "col >= start AND col < end".
+
+    This replaces __year lookups, which django compiles to BETWEEN with an
+    inclusive upper bound that depends on the precision of the column, and
+    combinations of __year, __month and __day lookups on the same column,
+    which would otherwise each be compiled to DATEPART(x, col) = n.
+    """
+    def __init__(self, lvalue, year, month=None, day=None):
+        self.lvalue = lvalue
+        self.year, self.month, self.day = year, month, day
+
+    def bounds(self):
+        """
+        Return the start and (exclusive) end of the range as datetimes. The
+        end is None for a range that runs to the end of year 9999.
+        """
+        if self.month is None:
+            start = datetime.datetime(self.year, 1, 1)
+            end = _start_of_year(self.year + 1)
+        elif self.day is None:
+            start = datetime.datetime(self.year, self.month, 1)
+            if self.month == 12:
+                end = _start_of_year(self.year + 1)
+            else:
+                end = datetime.datetime(self.year, self.month + 1, 1)
+        else:
+            start = datetime.datetime(self.year, self.month, self.day)
+            if start.date() == datetime.date.max:
+                end = None
+            else:
+                end = start + datetime.timedelta(days=1)
+        return start, end
+
+    def as_sql(self, qn, connection):
+        start, end = self.bounds()
+        lvalue, params = _process(self.lvalue, 'gte', start, connection)
+        field_sql = WhereNode().sql_for_columns(lvalue, qn, connection)
+        if end is None:
+            return '%s >= %%s' % field_sql, list(params)
+        lvalue, end_params = _process(self.lvalue, 'lt', end, connection)
+        params = list(params) + list(end_params)
+        return '(%s >= %%s AND %s < %%s)' % (field_sql, field_sql), params
+
+    def relabel_aliases(self, change_map):
+        self.lvalue = _relabel(self.lvalue, change_map)
+
+
+class CaseInsensitiveNode(object):
+    """
+    A case insensitive lookup that takes the collation of the column into
+    account.
+
+    Most databases use a case insensitive collation, where "col = %s"
+    already ignores case and can seek an index on the column, whereas the
+    LIKE pattern of an __iexact lookup can only use the index as a range.
+    On a case sensitive collation, the column and the value are compared in
+    upper case, so an index on a computed UPPER(col) column can be used.
+
+    ``case_insensitive`` tells whether the collation of the column is case
+    insensitive; it is looked up when the where tree is rewritten.
+    """
+    lookup_types = ('iexact', 'icontains', 'istartswith', 'iendswith')
+
+    def __init__(self, lvalue, lookup_type, value, case_insensitive):
+        self.lvalue = lvalue
+        self.lookup_type = lookup_type
+        self.value = value
+        self.case_insensitive = case_insensitive
+
+    def as_sql(self, qn, connection):
+        case_insensitive = self.case_insensitive
+        if case_insensitive and self.lookup_type == 'iexact':
+            lvalue, params = _process(self.lvalue, 'exact', self.value, connection)
+            operator = connection.operators['exact']
+        else:
+            lvalue, params = _process(self.lvalue, self.lookup_type, self.value, connection)
+            operator = connection.operators[self.lookup_type]
+        field_sql = WhereNode().sql_for_columns(lvalue, qn, connection)
+        if not case_insensitive:
+            field_sql = 'UPPER(%s)' % field_sql
+            operator = operator.replace('%s', 'UPPER(%s)')
+        return '%s %s' % (field_sql, operator), params
+
+    def relabel_aliases(self, change_map):
+        self.lvalue = _relabel(self.lvalue, change_map)
+
+
+class RegexNode(object):
+    """
+    A __regex or __iregex lookup, compiled to LIKE patterns where the
+    regular expression can be translated to them (see regex.py).
+
+    The call to dbo.REGEXP_LIKE is kept as a residual filter, evaluated only
+    for the rows matching the patterns, unless the patterns are equivalent
+    to the expression for the collation of the column. Patterns with a
+    literal prefix can seek an index on the column.
+    """
+    def __init__(self, lvalue, lookup_type, value):
+        self.lvalue = lvalue
+        self.lookup_type = lookup_type
+        self.value = value
+
+    def as_sql(self, qn, connection):
+        lvalue, params = _process(self.lvalue, self.lookup_type, self.value, connection)
+        field_sql = WhereNode().sql_for_columns(lvalue, qn, connection)
+        regex_sql = connection.ops.regex_lookup(self.lookup_type) % (field_sql, '%s')
+
+        translation = regex_to_like(self.value)
+        if translation is None:
+            return regex_sql, params
+        patterns, exact, ranges = translation
+
+        collation = (connection.ops.collation(*_column_of(self.lvalue)) or '').upper()
+        binary = '_BIN' in collation
+        case_sensitive = binary or '_CS' in collation
+        cased = [c for c in self.value if c.lower() != c.upper()]
+        if cased and case_sensitive and self.lookup_type == 'iregex':
+            # The patterns would only match one case.
+            return regex_sql, params
+
+        if not binary:
+            exact = exact and not ranges and '_AS' in collation and '_WS' in collation
+        if cased:
+            exact = exact and case_sensitive == (self.lookup_type == 'regex')
+
+        like_sql = ' OR '.join(["%s LIKE %%s ESCAPE '\\'" % field_sql] * len(patterns))
+        if len(patterns) > 1:
+            like_sql = '(%s)' % like_sql
+        if exact:
+            return like_sql, patterns
+        return '(%s AND %s)' % (like_sql, regex_sql), patterns + list(params)
+
+    def relabel_aliases(self, change_map):
+        self.lvalue = _relabel(self.lvalue, change_map)
+
+
+class FullTextNode(object):
+    """
+    Matches rows with CONTAINS(columns, terms) or FREETEXT(columns, terms).
+
+    ``columns`` is a list of (alias, column) tuples, which must all belong
+    to the same full-text index.
+    """
+    def __init__(self, columns, terms, freetext=False):
+        self.columns = list(columns)
+        self.terms = terms
+        self.freetext = freetext
+
+    def as_sql(self, qn, connection):
+        columns = ['%s.%s' % (qn(alias), qn(column)) for alias, column in self.columns]
+        if len(columns) == 1:
+            column_sql = columns[0]
+        else:
+            column_sql = '(%s)' % ', '.join(columns)
+        function = self.freetext and 'FREETEXT' or 'CONTAINS'
+        return '%s(%s, %%s)' % (function, column_sql), [self.terms]
+
+    def relabel_aliases(self, change_map):
+        self.columns = [(change_map.get(alias, alias), column) for alias, column in self.columns]
+
+
+class LargeInNode(object):
+    """
+    Matches a column against a long list of values, sent as a single
+    parameter that is shredded into rows on the server.
+
+    Every value of an __in lookup is a separate parameter, and SQL Server
+    accepts at most 2100 parameters per request. Lists longer than the
+    large_in_threshold of the connection's operations are rewritten to
+    "col IN (SELECT ... FROM <xml>.nodes('/v'))". With the 'xml' strategy
+    the parameter is an XML document "<v>1</v><v>2</v>..."; the 'delimited'
+    strategy sends lists of numbers as the shorter "1,2,..." and builds the
+    XML on the server.
+
+    Strings are read back as nvarchar(max), numbers as a type that holds
+    every value, and dates as ISO 8601 text converted with CONVERT style
+    126, so each value compares as it would as a parameter. Lists with a
+    value that would not be read back as the same value, such as floats,
+    datetimes with microseconds or strings with control characters, and
+    columns of other types are left as IN lists.
+    """
+    def __init__(self, lvalue, annotation, values):
+        self.lvalue = lvalue
+        self.annotation = annotation
+        self.values = values
+
+    def as_sql(self, qn, connection):
+        lvalue, params = _process(self.lvalue, 'in', self.values, connection)
+        shredded = params and _shred_values(_type_name(lvalue[2]), params)
+        if not shredded:
+            return WhereNode().make_atom((self.lvalue, 'in', self.annotation, self.values), qn, connection)
+
+        value_sql, texts, numeric = shredded
+        field_sql = WhereNode().sql_for_columns(lvalue, qn, connection)
+        if connection.ops.large_in_strategy == 'delimited' and numeric:
+            doc_sql = "CAST('<v>' + REPLACE(CAST(%s AS varchar(max)), ',', '</v><v>') + '</v>' AS xml)"
+            doc = ','.join(texts)
+        else:
+            doc_sql = 'CONVERT(xml, %s, 1)'
+            doc = u''.join([u'<v>%s</v>' % _xml_escape(text) for text in texts])
+        sql = "%s IN (SELECT %s FROM (SELECT %s AS [doc]) AS [d] " \
+            "CROSS APPLY [d].[doc].nodes('/v') AS [keys] ([v]))" % (field_sql, value_sql, doc_sql)
+        return sql, [doc]
+
+    def relabel_aliases(self, change_map):
+        self.lvalue = _relabel(self.lvalue, change_map)
+
+
+# The data type name at the start of a column definition.
+_re_type_name = re.compile(r'^\s*(\w+)')
+
+# The column types whose __in lookups LargeInNode shreds from XML.
+_string_types = ('char', 'varchar', 'nchar', 'nvarchar')
+_numeric_types = ('bigint', 'int', 'smallint', 'tinyint', 'decimal', 'numeric', 'money', 'smallmoney')
+_date_types = ('date', 'datetime', 'datetime2', 'smalldatetime')
+
+# A date or datetime in ISO 8601 form, with at most the 3 fractional digits
+# that CONVERT style 126 accepts for datetime.
+_re_iso_datetime = re.compile(r'^\d{4}-\d\d-\d\d(?:[T ]\d\d:\d\d:\d\d(?:\.\d{1,3})?)?$')
+
+# Characters that XML cannot represent, or that an XML parser normalizes.
+_re_xml_unsafe = re.compile(u'[\x00-\x08\x0b-\x1f]')
+
+def _type_name(db_type):
+    """Return the lower case name of the data type of a column definition."""
+    match = db_type and _re_type_name.match(db_type)
+    if not match:
+        return None
+    return match.group(1).lower()
+
+def _shred_values(type_name, values):
+    """
+    Return (value_sql, texts, numeric) to shred the values of an __in lookup
+    on a column of the given type from XML: the expression that reads a
+    value from the [keys].[v] node, the text of each value, and whether the
+    values are numbers. Returns None if a value would not be read back as
+    the same value.
+    """
+    if type_name in _string_types:
+        for value in values:
+            if not isinstance(value, basestring) or _re_xml_unsafe.search(value):
+                return None
+        # Not the type of the column, which would truncate longer values.
+        return "[keys].[v].value('.', 'nvarchar(max)')", list(values), False
+    if type_name in _numeric_types:
+        return _shred_numbers(values)
+    if type_name in _date_types:
+        texts = []
+        for value in values:
+            if isinstance(value, datetime.datetime):
+                if value.tzinfo is not None or value.microsecond % 1000:
+                    return None
+                text = u'%04d-%02d-%02dT%02d:%02d:%02d.%03d' % (value.year, value.month, value.day,
+                    value.hour, value.minute, value.second, value.microsecond // 1000)
+            elif isinstance(value, datetime.date):
+                text = u'%04d-%02d-%02d' % (value.year, value.month, value.day)
+            elif isinstance(value, basestring) and _re_iso_datetime.match(value):
+                text = value.replace(u' ', u'T')
+            else:
+                return None
+            if u'T' not in text:
+                text += u'T00:00:00'
+            texts.append(text)
+        return "CONVERT(%s, [keys].[v].value('.', 'varchar(23)'), 126)" % type_name, texts, False
+    return None
+
+def _shred_numbers(values):
+    """
+    Return the _shred_values() of a list of integers and decimals, read as
+    bigint or as a decimal with enough digits for every value.
+    """
+    digits = scale = 0
+    texts = []
+    for value in values:
+        if isinstance(value, bool) or not isinstance(value, (int, long, decimal.Decimal)):
+            return None
+        if isinstance(value, decimal.Decimal):
+            if not value.is_finite():
+                return None
+            sign, value_digits, exponent = value.as_tuple()
+            digits = max(digits, len(value_digits) + exponent)
+            scale = max(scale, -exponent)
+            texts.append('{0:f}'.format(value))
+        else:
+            digits = max(digits, len(str(abs(value))))
+            texts.append(str(value))
+    if not scale and digits <= 18:
+        value_type = 'bigint'
+    elif max(digits, 1) + scale <= 38:
+        value_type = 'decimal(%d, %d)' % (max(digits, 1) + scale, scale)
+    else:
+        return None
+    return "[keys].[v].value('.', '%s')" % value_type, texts, True
+
+def _xml_escape(text):
+    """Return the text escaped for an XML element."""
+    return text.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(u'>', u'&gt;')
+
+
+def _conjunction(node):
+    """
+    Yield (node, index, child) for the children of an AND node, including
+    those of nested AND nodes, which django adds for each filter() argument.
+    """
+    for i, child in enumerate(node.children):
+        if isinstance(child, tree.Node):
+            if child.connector == AND and not child.negated:
+                for item in _conjunction(child):
+                    yield item
+        else:
+            yield node, i, child
+
+def _rewrite_year_lookups(node):
+    """Replace the __year lookups of a where tree with DateRangeNodes."""
+    for i, child in enumerate(node.children):
+        if isinstance(child, tree.Node):
+            _rewrite_year_lookups(child)
+        elif _is_column_lookup(child) and child[1] == 'year':
+            node.children[i] = DateRangeNode(child[0], child[3])
+
+def _combine_date_lookups(node):
+    """
+    Combine a year range with __month and __day lookups on the same column
+    into a single range, if all of them have to match.
+    """
+    if node.connector == AND:
+        columns = {}
+        for parent, i, child in _conjunction(node):
+            if isinstance(child, DateRangeNode) and child.month is None:
+                lookups = columns.setdefault(_column_key(child.lvalue), {})
+                lookups.setdefault('year', []).append(child)
+            elif _is_column_lookup(child) and child[1] in ('month', 'day'):
+                lookups = columns.setdefault(_column_key(child[0]), {})
+                lookups.setdefault(child[1], []).append((parent, child))
+
+        removed = []
+        for lookups in columns.values():
+            years, months, days = [lookups.get(name, []) for name in ('year', 'month', 'day')]
+            if len(years) != 1 or len(months) != 1 or len(days) > 1:
+                continue
+            range_node = years[0]
+            month, day = months[0][1][3], None
+            if days:
+                day = days[0][1][3]
+            try:
+                datetime.date(range_node.year, month, day or 1)
+            except ValueError:
+                # The lookups match nothing; leave them to the database.
+                continue
+            range_node.month, range_node.day = month, day
+            removed.extend(months + days)
+
+        for parent, child in removed:
+            parent.children.remove(child)
+
+    for child in node.children:
+        if isinstance(child, tree.Node):
+            _combine_date_lookups(child)
+
+def _rewrite_case_insensitive_lookups(node, connection):
+    """Replace the case insensitive string lookups of a where tree with CaseInsensitiveNodes."""
+    for i, child in enumerate(node.children):
+        if isinstance(child, tree.Node):
+            _rewrite_case_insensitive_lookups(child, connection)
+        elif (_is_column_lookup(child) and child[1] in CaseInsensitiveNode.lookup_types
+            and isinstance(child[3], basestring)):
+            # The collation is cached per connection by DatabaseOperations.
+            case_insensitive = connection.ops.is_case_insensitive(*_column_of(child[0]))
+            node.children[i] = CaseInsensitiveNode(child[0], child[1], child[3], case_insensitive)
+
+def _rewrite_regex_lookups(node):
+    """Replace the __regex and __iregex lookups of a where tree with RegexNodes."""
+    for i, child in enumerate(node.children):
+        if isinstance(child, tree.Node):
+            _rewrite_regex_lookups(child)
+        elif _is_lookup(child) and child[1] in ('regex', 'iregex') and isinstance(child[3], basestring):
+            node.children[i] = RegexNode(child[0], child[1], child[3])
+
+def _rewrite_large_in_lookups(node, threshold):
+    """Replace the __in lookups with more than threshold values with LargeInNodes."""
+    for i, child in enumerate(node.children):
+        if isinstance(child, tree.Node):
+            _rewrite_large_in_lookups(child, threshold)
+        elif (_is_lookup(child) and child[1] == 'in' and isinstance(child[3], (list, tuple))
+            and len(child[3]) > threshold):
+            node.children[i] = LargeInNode(child[0], child[2], child[3])
+
+def _copy_tree(node):
+    """
+    Return a copy of the nodes of a where tree. The leaves are shared, as
+    the rewrites only replace or remove the children of nodes.
+    """
+    obj = copy.copy(node)
+    obj.children = [isinstance(child, tree.Node) and _copy_tree(child) or child
+        for child in node.children]
+    return obj
+
+def rewrite_where(node, connection=None):
+    """Return a copy of a where tree with the lookups rewritten into sargable forms."""
+    if not isinstance(node, tree.Node):
+        return node
+    node = _copy_tree(node)
+    threshold = getattr(getattr(connection, 'ops', None), 'large_in_threshold', None)
+    if threshold:
+        _rewrite_large_in_lookups(node, threshold)
+    _rewrite_year_lookups(node)
+    _combine_date_lookups(node)
+    if connection is not None:
+        _rewrite_case_insensitive_lookups(node, connection)
+    _rewrite_regex_lookups(node)
+    return node
@@ -407,3 +407,25 @@ class IntegerIdTable(models.Model):
     Simple table consisting of only an Integer ID primary key
     """
     id = models.IntegerField(primary_key=True)
+
+class Bug21ArchiveTable(models.Model):
+    """
+    Archive of purged Bug21Table rows, with the same columns.
+    """
+    id = models.IntegerField(primary_key=True)
+    a = models.CharField(max_length=50)
+    d = models.DecimalField(max_digits=5, decimal_places=2)
+
+class QueueTable(models.Model):
+    """
+    A work queue, with a lease column for TableQueue.
+    """
+    job = models.CharField(max_length=50)
+    leased_until = models.DateTimeField(null=True)
+
+class TreeNode(models.Model):
+    """
+    An adjacency list hierarchy for tree_query().
+    """
+    parent = models.ForeignKey('self', null=True, related_name='children')
+    name = models.CharField(max_length=50)
@@ -1,10 +1,38 @@
+from __future__ import with_statement
 import datetime
 import decimal
 from django.core.exceptions import ImproperlyConfigured
-from django.db import models
-from django.test import TestCase
+from django.db import models, IntegrityError
+from django.test import TestCase, TransactionTestCase
 
-from regressiontests.models import Bug69Table1, Bug69Table2, Bug70Table, Bug93Table, IntegerIdTable
+from regressiontests.models import Bug19Table, Bug21Table, Bug21ArchiveTable, Bug27Table, Bug63Table, Bug69Table1, Bug69Table2, Bug70Table, Bug93Table, IntegerIdTable, QueueTable, TreeNode
+
+def _in_thread(func, *args):
+    """
+    Call func in a new thread, which has a connection of its own, and return
+    its result. Only committed changes are seen there.
+    """
+    import sys
+    import threading
+    import pythoncom
+    from django.db import connection
+    result = {}
+    def run():
+        pythoncom.CoInitialize()
+        try:
+            try:
+                result['value'] = func(*args)
+            except Exception:
+                result['error'] = sys.exc_info()
+        finally:
+            connection.close()
+            pythoncom.CoUninitialize()
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    if 'error' in result:
+        raise result['error'][0], result['error'][1], result['error'][2]
+    return result['value']
 
 class Bug38Table(models.Model):
     d = models.DecimalField(max_digits=5, decimal_places=2)
@@ -150,6 +178,81 @@ class Bug93TestCase(TestCase):
         dates = Bug93Table.objects.filter(dt__year='2010')
         self.assertTrue(dates.count() == 2)
 
+class DateRangeLookupTestCase(TestCase):
+    def setUp(self):
+        for dt in (
+            datetime.datetime(2009, 12, 31, 23, 59, 59),
+            datetime.datetime(2010, 1, 1),
+            datetime.datetime(2010, 2, 28, 12, 30),
+            datetime.datetime(2010, 3, 1),
+            datetime.datetime(2010, 12, 31, 23, 59, 59),
+            datetime.datetime(2011, 1, 1),
+        ):
+            Bug93Table.objects.create(dt=dt, d=dt.date())
+
+    def testYearBounds(self):
+        self.assertEquals(Bug93Table.objects.filter(dt__year=2010).count(), 4)
+        self.assertEquals(Bug93Table.objects.filter(d__year=2010).count(), 4)
+        self.assertEquals(Bug93Table.objects.exclude(dt__year=2010).count(), 2)
+
+    def testYearMonth(self):
+        self.assertEquals(Bug93Table.objects.filter(dt__year=2010, dt__month=2).count(), 1)
+        self.assertEquals(Bug93Table.objects.filter(dt__year=2010).filter(dt__month=12).count(), 1)
+        self.assertEquals(Bug93Table.objects.filter(d__year=2009, d__month=12, d__day=31).count(), 1)
+        self.assertEquals(Bug93Table.objects.filter(dt__year=2010, dt__month=2, dt__day=30).count(), 0)
+        self.assertEquals(Bug93Table.objects.exclude(dt__year=2010, dt__month=3).count(), 5)
+
+    def testYearDay(self):
+        self.assertEquals(Bug93Table.objects.filter(dt__year=2010, dt__day=1).count(), 2)
+
+    def testLastYear(self):
+        dt = datetime.datetime(9999, 12, 31, 23, 59, 59)
+        Bug93Table.objects.create(dt=dt, d=dt.date())
+        self.assertEquals(Bug93Table.objects.filter(dt__year=9999).count(), 1)
+        self.assertEquals(Bug93Table.objects.filter(d__year=9999, d__month=12).count(), 1)
+        self.assertEquals(Bug93Table.objects.filter(dt__year=9999, dt__month=12, dt__day=31).count(), 1)
+        self.assertEquals(Bug93Table.objects.exclude(dt__year=9999).count(), 6)
+
+    def testAggregateYear(self):
+        from django.db.models import Max
+        qs = Bug93Table.objects.values('d').annotate(m=Max('dt')).filter(m__year=2010)
+        self.assertEquals(qs.count(), 4)
+
+    def testQueryUnchanged(self):
+        from django.db import connection
+        qs = Bug93Table.objects.filter(dt__year=2010, dt__month=2)
+        children = repr(qs.query.where.children)
+        qs.query.get_compiler(connection=connection).as_sql()
+        self.assertEquals(repr(qs.query.where.children), children)
+        self.assertEquals(qs.count(), 1)
+
+class CaseInsensitiveLookupTestCase(TestCase):
+    def setUp(self):
+        for choice in (u'Hello World', u'hello_world', u'[brackets]'):
+            Bug19Table.objects.create(choice=choice)
+
+    def testIExact(self):
+        self.assertEquals(Bug19Table.objects.filter(choice__iexact='HELLO WORLD').count(), 1)
+        self.assertEquals(Bug19Table.objects.filter(choice__iexact='hello_world').count(), 1)
+        self.assertEquals(Bug19Table.objects.filter(choice__iexact='[BRACKETS]').count(), 1)
+        self.assertEquals(Bug19Table.objects.exclude(choice__iexact='hello world').count(), 2)
+
+    def testILike(self):
+        self.assertEquals(Bug19Table.objects.filter(choice__istartswith='HELLO').count(), 2)
+        self.assertEquals(Bug19Table.objects.filter(choice__icontains='O_W').count(), 1)
+        self.assertEquals(Bug19Table.objects.filter(choice__iendswith='TS]').count(), 1)
+
+    def testAggregate(self):
+        from django.db.models import Max
+        qs = Bug19Table.objects.values('choice').annotate(m=Max('choice')).filter(m__iexact='HELLO WORLD')
+        self.assertEquals(qs.count(), 1)
+
+    def testCollation(self):
+        from django.db import connection
+        collation = connection.ops.collation(Bug19Table._meta.db_table, 'choice')
+        self.assertTrue(collation)
+        self.assertEquals(connection.ops.collation(), connection.ops.collation(None, None))
+
 class BasicFunctionalityTestCase(TestCase):
     def testRandomOrder(self):
         """
@@ -172,6 +275,14 @@ class BasicFunctionalityTestCase(TestCase):
         objs = IntegerIdTable.objects.raw("SELECT [id] FROM [regressiontests_IntegerIdTable]")
         self.assertEquals(len(list(objs)), 4)
 
+    def testDistinctOffset(self):
+        for x in xrange(20):
+            Bug38Table.objects.create(d=x % 10)
+
+        qs = Bug38Table.objects.values_list('d', flat=True).distinct().order_by('d')
+        self.assertEquals(list(qs[5:10]), range(5, 10))
+        self.assertEquals(len(Bug38Table.objects.values('d').distinct()[5:10]), 5)
+
 class ConnectionStringTestCase(TestCase):
     def assertInString(self, conn_string, pattern):
         """
@@ -241,3 +352,649 @@ class ConnectionStringTestCase(TestCase):
         extras = 'Some=Extra;Stuff Goes=here'
         conn_string = self.get_conn_string({'OPTIONS': {'extra_params': extras}})
         self.assertInString(conn_string, extras)
+
+class ApproximateCountTestCase(TestCase):
+    def setUp(self):
+        for x in xrange(1,6):
+            IntegerIdTable.objects.create(id=x)
+
+    def testExactBelowThreshold(self):
+        from django.db import connection
+        count, exact = connection.ops.approximate_count(IntegerIdTable, exact_threshold=100)
+        self.assertEquals((count, exact), (5, True))
+
+    def testEstimate(self):
+        from django.db import connection
+        count, exact = connection.ops.approximate_count(IntegerIdTable._meta.db_table)
+        self.assertFalse(exact)
+        self.assertTrue(count >= 0)
+
+    def testFilteredQuerySetIsExact(self):
+        from sqlserver_ado.queryset import approximate_count
+        count, exact = approximate_count(IntegerIdTable.objects.filter(id__gt=2))
+        self.assertEquals((count, exact), (3, True))
+
+    def testPaginator(self):
+        from sqlserver_ado.paginator import ApproximateCountPaginator
+        pager = ApproximateCountPaginator(IntegerIdTable.objects.order_by('id'), 2)
+        self.assertEquals(pager.count, 5)
+        self.assertTrue(pager.exact)
+        self.assertEquals(pager.num_pages, 3)
+
+class ExistsTestCase(TestCase):
+    def setUp(self):
+        for x in xrange(1,6):
+            IntegerIdTable.objects.create(id=x)
+
+    def testExists(self):
+        self.assertTrue(IntegerIdTable.objects.exists())
+        self.assertTrue(IntegerIdTable.objects.filter(id=3).order_by('-id').exists())
+        self.assertFalse(IntegerIdTable.objects.filter(id=10).exists())
+        self.assertTrue(IntegerIdTable.objects.distinct().exists())
+
+    def testSlicedExists(self):
+        qs = IntegerIdTable.objects.order_by('id')
+        self.assertTrue(qs[4:].exists())
+        self.assertFalse(qs[5:].exists())
+        self.assertTrue(qs[2:3].exists())
+
+    def testGroupedExists(self):
+        from django.db.models import Count
+        qs = IntegerIdTable.objects.values('id').annotate(n=Count('id'))
+        self.assertTrue(qs.filter(n=1).exists())
+        self.assertFalse(qs.filter(n__gt=1).exists())
+
+class QueryTemplateCacheTestCase(TestCase):
+    def setUp(self):
+        from django.db import connection
+        from sqlserver_ado.querycache import QueryTemplateCache
+        for x in xrange(1,6):
+            IntegerIdTable.objects.create(id=x)
+        self.connection = connection
+        self.old_cache = getattr(connection, 'query_cache', None)
+        self.cache = connection.query_cache = QueryTemplateCache()
+
+    def tearDown(self):
+        self.connection.query_cache = self.old_cache
+
+    def testHitsBindNewParameters(self):
+        for x in xrange(1,6):
+            objs = list(IntegerIdTable.objects.filter(id__gte=x).order_by('id')[1:3])
+            self.assertEquals([o.id for o in objs], range(x+1, min(x+3, 6)))
+
+        stats = self.cache.stats()
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['hits'], 4)
+
+    def testSameSql(self):
+        def compile(qs):
+            return qs.query.get_compiler(using=qs.db).as_sql()
+
+        querysets = [
+            IntegerIdTable.objects.filter(id__gte=2)[1:3],
+            IntegerIdTable.objects.filter(id__gte=2).order_by('-id')[1:3],
+            IntegerIdTable.objects.exclude(id=2)[:2],
+            IntegerIdTable.objects.all()[1:3],
+        ]
+        self.connection.query_cache = None
+        expected = [compile(qs) for qs in querysets]
+        self.connection.query_cache = self.cache
+        self.assertEquals([compile(qs) for qs in querysets], expected)
+        self.assertEquals([compile(qs) for qs in querysets], expected)
+        self.assertEquals(self.cache.stats()['hits'], len(querysets))
+
+    def testUncacheable(self):
+        from django.db.models import Count
+        self.assertEquals(IntegerIdTable.objects.aggregate(n=Count('id')), {'n': 5})
+        self.assertEquals(self.cache.stats()['hits'], 0)
+
+class FullTextTestCase(TestCase):
+    def _sql(self, qs):
+        from django.db import connection
+        return qs.query.get_compiler(connection=connection).as_sql()
+
+    def testContains(self):
+        from sqlserver_ado.queryset import SqlServerQuerySet
+        qs = SqlServerQuerySet(Bug19Table).ft_contains('choice', '"fold*"').filter(id__gt=1)
+        sql, params = self._sql(qs)
+        self.assertTrue('CONTAINS(' in sql)
+        self.assertEquals(list(params), ['"fold*"', 1])
+
+        sql, params = self._sql(SqlServerQuerySet(Bug19Table).ft_freetext(['choice'], 'folder'))
+        self.assertTrue('FREETEXT(' in sql)
+
+    def testRankedSearch(self):
+        from sqlserver_ado.queryset import SqlServerQuerySet
+        qs = SqlServerQuerySet(Bug19Table).ranked_search('folder', top_n=10).filter(id__gt=1)[2:4]
+        sql, params = self._sql(qs)
+        self.assertTrue('CONTAINSTABLE(' in sql)
+        self.assertEquals(list(params), ['folder', 1])
+
+    def testCreationSql(self):
+        from django.db import connection
+        from django.core.management.color import no_style
+        self.assertEquals(connection.creation.sql_fulltext_for_model(Bug19Table, no_style()), [])
+        Bug19Table.fulltext_fields = ('choice',)
+        try:
+            output = connection.creation.sql_fulltext_for_model(Bug19Table, no_style())
+        finally:
+            del Bug19Table.fulltext_fields
+        self.assertEquals(len(output), 2)
+        self.assertTrue('CREATE FULLTEXT INDEX ON [%s] ([choice])' % Bug19Table._meta.db_table in output[1])
+
+    def testIntrospection(self):
+        from django.db import connection
+        columns = connection.introspection.get_fulltext_columns(connection.cursor(), Bug19Table._meta.db_table)
+        self.assertEquals(columns, [])
+
+class InsertIdTestCase(TestCase):
+    def testReturnsScopeIdentity(self):
+        from django.db import connection
+        for x in xrange(5):
+            Bug21Table.objects.create(a='filler', d='1.00')
+
+        # A trigger inserting into another table must not change the id
+        # returned for the insert.
+        cursor = connection.cursor()
+        cursor.execute("""CREATE TRIGGER [bug27_insert_trigger] ON %s AFTER INSERT AS
+            INSERT INTO %s ([a], [d]) SELECT 'trigger', 1.00 FROM inserted""" % (
+            connection.ops.quote_name(Bug27Table._meta.db_table),
+            connection.ops.quote_name(Bug21Table._meta.db_table)))
+
+        first = Bug27Table.objects.create(a=1)
+        second = Bug27Table.objects.create(a=2)
+        self.assertEquals(Bug27Table.objects.get(a=1).pk, first.pk)
+        self.assertEquals(Bug27Table.objects.get(a=2).pk, second.pk)
+        self.assertEquals(Bug21Table.objects.filter(a='trigger').count(), 2)
+
+class BulkInsertTestCase(TestCase):
+    def testKeysMatchInstances(self):
+        from django.db import connection
+        connection.ops.max_query_params = 10
+        try:
+            objs = [Bug27Table(a=x) for x in xrange(25)]
+            connection.ops.bulk_insert(objs)
+        finally:
+            del connection.ops.max_query_params
+
+        self.assertEquals(Bug27Table.objects.count(), 25)
+        for obj in objs:
+            self.assertEquals(Bug27Table.objects.get(pk=obj.pk).a, obj.a)
+
+    def testBigAutoField(self):
+        from django.db import connection
+        objs = [Bug63Table(number=2147483648L + x) for x in xrange(3)]
+        connection.ops.bulk_insert(objs)
+        for obj in objs:
+            self.assertTrue(isinstance(obj.pk, long))
+            self.assertEquals(Bug63Table.objects.get(pk=obj.pk).number, obj.number)
+
+    def testExplicitKeys(self):
+        from django.db import connection
+        connection.ops.bulk_insert([IntegerIdTable(id=x) for x in (3, 1, 2)])
+        connection.ops.bulk_insert([Bug27Table(id=100, a=1), Bug27Table(a=2)])
+        self.assertEquals(list(IntegerIdTable.objects.order_by('id').values_list('id', flat=True)), [1, 2, 3])
+        self.assertEquals(Bug27Table.objects.get(id=100).a, 1)
+        self.assertEquals(Bug27Table.objects.filter(a=2).count(), 1)
+
+class BulkInsertCommitTestCase(TransactionTestCase):
+    def testCommitted(self):
+        from django.db import connection
+        connection.ops.bulk_insert([Bug27Table(a=x) for x in xrange(3)])
+        self.assertEquals(_in_thread(Bug27Table.objects.count), 3)
+
+class IdentityInsertTestCase(TestCase):
+    def testTrackedPerTable(self):
+        from django.db import connection
+        qn = connection.ops.quote_name
+        Bug27Table(id=50, a=1).save(force_insert=True)
+        Bug27Table(id=51, a=2).save(force_insert=True)
+        self.assertEquals(connection.identity_insert_table, qn(Bug27Table._meta.db_table))
+
+        Bug21Table(id=60, a='x', d='1.00').save(force_insert=True)
+        self.assertEquals(connection.identity_insert_table, qn(Bug21Table._meta.db_table))
+
+        # Generated ids need IDENTITY_INSERT off again.
+        obj = Bug21Table.objects.create(a='y', d='2.00')
+        self.assertEquals(connection.identity_insert_table, None)
+        self.assertTrue(obj.pk > 60)
+        self.assertEquals(Bug27Table.objects.filter(id__in=[50, 51]).count(), 2)
+
+    def testRecordedAfterExecute(self):
+        from django.db import connection
+        qn = connection.ops.quote_name
+        table = qn(Bug27Table._meta.db_table)
+        before, after = connection.identity_insert_sql(table, True)
+        self.assertEquals(before, 'SET IDENTITY_INSERT %s ON' % table)
+        self.assertEquals(connection.identity_insert_table, None)
+
+        existing = Bug21Table.objects.create(a='x', d='1.00')
+        Bug27Table(id=50, a=1).save(force_insert=True)
+        self.assertEquals(connection.identity_insert_table, table)
+        # A failed insert may have left IDENTITY_INSERT on for its table.
+        obj = Bug21Table(id=existing.pk, a='y', d='1.00')
+        self.assertRaises(IntegrityError, obj.save, force_insert=True)
+        self.assertEquals(connection.identity_insert_table, qn(Bug21Table._meta.db_table))
+
+class UpsertTestCase(TestCase):
+    def setUp(self):
+        from django.db import connection
+        self.ops = connection.ops
+        self.has_merge = connection.is_sql2008()
+
+    def testBulkUpsert(self):
+        if not self.has_merge:
+            from sqlserver_ado.base import DatabaseError
+            self.assertRaises(DatabaseError, self.ops.bulk_upsert, Bug21Table, [{'a': 'one'}], ['a'])
+            return
+        Bug21Table.objects.create(a='one', d='1.00')
+        count = self.ops.bulk_upsert(Bug21Table,
+            [{'a': 'one', 'd': '1.50'}, {'a': 'two', 'd': '2.00'}], ['a'])
+        self.assertEquals(count, 2)
+        self.assertEquals(Bug21Table.objects.get(a='one').d, decimal.Decimal('1.50'))
+        self.assertEquals(Bug21Table.objects.get(a='two').d, decimal.Decimal('2.00'))
+
+        changes = self.ops.bulk_upsert(Bug21Table,
+            [{'a': 'two', 'd': '2.50'}, {'a': 'three', 'd': '3.00'}], ['a'], returning=True)
+        self.assertEquals(sorted([action for action, pk in changes]), ['INSERT', 'UPDATE'])
+        self.assertEquals(dict(changes)['UPDATE'], Bug21Table.objects.get(a='two').pk)
+
+    def testInsertOnly(self):
+        if not self.has_merge:
+            return
+        Bug21Table.objects.create(a='one', d='1.00')
+        self.ops.bulk_upsert(Bug21Table, [{'a': 'one', 'd': '9.00'}], ['a'], update_fields=[])
+        self.assertEquals(Bug21Table.objects.get(a='one').d, decimal.Decimal('1.00'))
+
+    def testGetOrCreate(self):
+        obj, created = self.ops.get_or_create(Bug21Table, a='one', defaults={'d': '1.00'})
+        self.assertTrue(created)
+        self.assertEquals(obj.d, decimal.Decimal('1.00'))
+        again, created = self.ops.get_or_create(Bug21Table, a='one', defaults={'d': '5.00'})
+        self.assertFalse(created)
+        self.assertEquals(again.pk, obj.pk)
+        self.assertEquals(again.d, decimal.Decimal('1.00'))
+
+class UpsertCommitTestCase(TransactionTestCase):
+    def testCommitted(self):
+        from django.db import connection
+        if connection.is_sql2008():
+            connection.ops.bulk_upsert(Bug21Table, [{'a': 'one', 'd': '1.00'}], ['a'])
+        else:
+            Bug21Table.objects.create(a='one', d='1.00')
+        connection.ops.get_or_create(Bug21Table, a='two', defaults={'d': '2.00'})
+        self.assertEquals(_in_thread(Bug21Table.objects.count), 2)
+
+class BulkUpdateTestCase(TestCase):
+    def testDistinctValues(self):
+        from django.db import connection
+        objs = [Bug21Table.objects.create(a='row%d' % i, d='1.00') for i in range(5)]
+        for i, obj in enumerate(objs):
+            obj.a = 'new%d' % i
+            obj.d = decimal.Decimal(i)
+        self.assertEquals(connection.ops.bulk_update(objs[:4], ['a', 'd'], batch_size=3), 4)
+        rows = list(Bug21Table.objects.order_by('id').values_list('a', 'd'))
+        self.assertEquals(rows[:4], [(u'new%d' % i, decimal.Decimal(i)) for i in range(4)])
+        self.assertEquals(rows[4], (u'row4', decimal.Decimal('1.00')))
+
+    def testPrimaryKeyRejected(self):
+        from django.db import connection
+        obj = Bug21Table.objects.create(a='row', d='1.00')
+        self.assertRaises(ValueError, connection.ops.bulk_update, [obj], ['id'])
+
+class BulkUpdateCommitTestCase(TransactionTestCase):
+    def testCommitted(self):
+        from django.db import connection
+        objs = [Bug21Table.objects.create(a='row%d' % i, d='1.00') for i in range(3)]
+        for obj in objs:
+            obj.d = decimal.Decimal('2.00')
+        connection.ops.bulk_update(objs, ['d'])
+        self.assertEquals(_in_thread(Bug21Table.objects.filter(d='2.00').count), 3)
+
+class PurgeTestCase(TestCase):
+    def setUp(self):
+        from sqlserver_ado.queryset import SqlServerQuerySet
+        for i in range(7):
+            Bug21Table.objects.create(a=i % 2 and 'odd' or 'even', d='%d.00' % i)
+        self.qs = SqlServerQuerySet(Bug21Table).filter(a='even')
+
+    def testBatches(self):
+        seen = []
+        self.assertEquals(self.qs.purge(batch_size=3, progress=seen.append), 4)
+        self.assertEquals(seen, [3, 4])
+        self.assertEquals(Bug21Table.objects.filter(a='even').count(), 0)
+        self.assertEquals(Bug21Table.objects.filter(a='odd').count(), 3)
+
+    def testExactBatches(self):
+        seen = []
+        self.assertEquals(self.qs.purge(batch_size=2, progress=seen.append), 4)
+        self.assertEquals(seen, [2, 4])
+        self.assertEquals(self.qs.purge(batch_size=2, progress=seen.append), 0)
+        self.assertEquals(seen, [2, 4])
+
+    def testArchive(self):
+        ids = list(self.qs.values_list('id', flat=True))
+        self.assertEquals(self.qs.purge(archive=Bug21ArchiveTable, batch_size=2), 4)
+        archived = Bug21ArchiveTable.objects.order_by('id')
+        self.assertEquals([obj.id for obj in archived], sorted(ids))
+        self.assertEquals(archived[0].d, decimal.Decimal('0.00'))
+
+    def testStopAndResume(self):
+        self.assertEquals(self.qs.purge(batch_size=1, progress=lambda total: False), 1)
+        self.assertEquals(Bug21Table.objects.filter(a='even').count(), 3)
+        self.assertEquals(self.qs.purge(batch_size=1), 3)
+        self.assertEquals(Bug21Table.objects.filter(a='even').count(), 0)
+
+    def testManaged(self):
+        # The test runs in a managed transaction, which purge() leaves open.
+        from django.db import transaction
+        transaction.set_clean()
+        self.assertEquals(self.qs.purge(batch_size=3), 4)
+        self.assertTrue(transaction.is_managed())
+        self.assertTrue(transaction.is_dirty())
+
+class LargeInTestCase(TestCase):
+    def setUp(self):
+        from django.db import connection
+        self.ops = connection.ops
+        self.threshold, self.strategy = self.ops.large_in_threshold, self.ops.large_in_strategy
+        self.ops.large_in_threshold = 3
+        for i in range(6):
+            Bug21Table.objects.create(a='<%d & more>' % i, d='%d.00' % i)
+
+    def tearDown(self):
+        self.ops.large_in_threshold, self.ops.large_in_strategy = self.threshold, self.strategy
+
+    def testStrategies(self):
+        ids = list(Bug21Table.objects.order_by('id').values_list('id', flat=True))
+        for strategy in ('xml', 'delimited'):
+            self.ops.large_in_strategy = strategy
+            self.assertEquals(Bug21Table.objects.filter(id__in=ids[:4]).count(), 4)
+            self.assertEquals(Bug21Table.objects.exclude(id__in=ids[1:5]).count(), 2)
+
+    def testStrings(self):
+        values = ['<%d & more>' % i for i in (0, 2, 4, 9)]
+        self.assertEquals(Bug21Table.objects.filter(a__in=values).count(), 3)
+
+    def testLongStrings(self):
+        Bug21Table.objects.create(a='x' * 50, d='1.00')
+        values = ['x' * 50 + 'y', 'a', 'b', 'c']
+        self.assertEquals(Bug21Table.objects.filter(a__in=values).count(), 0)
+        self.assertEquals(Bug21Table.objects.filter(a__in=values + ['x' * 50]).count(), 1)
+
+    def testDatetimes(self):
+        datetimes = [datetime.datetime(2010, 1, i, 12, 30, 15, 500000) for i in range(1, 5)]
+        for dt in datetimes:
+            Bug93Table.objects.create(dt=dt, d=dt.date())
+        self.assertEquals(Bug93Table.objects.filter(dt__in=datetimes[:3] + [datetime.datetime(2011, 1, 1)]).count(), 3)
+        self.assertEquals(Bug93Table.objects.filter(d__in=[dt.date() for dt in datetimes[1:]]).count(), 3)
+
+    def testPastParameterLimit(self):
+        ids = list(Bug21Table.objects.values_list('id', flat=True)) + range(-5000, 0)
+        self.assertEquals(Bug21Table.objects.filter(id__in=ids).count(), 6)
+
+class StagedKeysTestCase(TestCase):
+    def testJoin(self):
+        from django.db import connection
+        objs = [Bug21Table.objects.create(a='row%d' % i, d='1.00') for i in range(5)]
+        ids = [objs[0].pk, objs[3].pk, objs[3].pk, -1]
+        with connection.ops.staged_keys(ids) as keys:
+            qs = Bug21Table.objects.extra(where=['[id] IN (SELECT [key] FROM %s)' % keys])
+            self.assertEquals(sorted(qs.values_list('a', flat=True)), [u'row0', u'row3'])
+            cursor = connection.cursor()
+            cursor.execute('SELECT COUNT(*) FROM %s' % keys)
+            self.assertEquals(cursor.fetchone()[0], 3)
+        cursor.execute("SELECT OBJECT_ID('tempdb..%s')" % keys)
+        self.assertEquals(cursor.fetchone()[0], None)
+
+    def testCompositeKeys(self):
+        from django.db import connection
+        rows = [(i, 'k%d' % i) for i in range(2500)]
+        with connection.ops.staged_keys(rows, ['int', 'nvarchar(10)']) as keys:
+            cursor = connection.cursor()
+            cursor.execute('SELECT COUNT(*) FROM %s WHERE %s = 7' % (keys, keys.columns[0]))
+            self.assertEquals(cursor.fetchone()[0], 1)
+
+class SelectForUpdateTestCase(TestCase):
+    def _sql(self, qs):
+        from django.db import connection
+        return qs.query.get_compiler(connection=connection).as_sql()[0]
+
+    def testHints(self):
+        from sqlserver_ado.queryset import SqlServerQuerySet
+        qs = SqlServerQuerySet(Bug21Table).select_for_update().filter(a='x')
+        self.assertTrue('WITH (UPDLOCK, ROWLOCK) WHERE' in self._sql(qs))
+        self.assertTrue('WITH (UPDLOCK, ROWLOCK, READPAST)' in self._sql(qs.select_for_update(skip_locked=True)[:3]))
+        self.assertTrue('WITH (UPDLOCK, ROWLOCK, NOWAIT)' in self._sql(qs.select_for_update(nowait=True)[2:4]))
+        self.assertFalse('UPDLOCK' in self._sql(SqlServerQuerySet(Bug21Table).filter(a='x')))
+        self.assertRaises(ValueError, qs.select_for_update, nowait=True, skip_locked=True)
+
+    def testLockedRead(self):
+        from sqlserver_ado.queryset import SqlServerQuerySet
+        obj = Bug21Table.objects.create(a='counter', d='1.00')
+        locked = SqlServerQuerySet(Bug21Table).select_for_update().get(pk=obj.pk)
+        locked.d += 1
+        locked.save()
+        self.assertEquals(Bug21Table.objects.get(pk=obj.pk).d, decimal.Decimal('2.00'))
+
+class TableQueueTestCase(TestCase):
+    def _enqueue(self, queue, count):
+        return queue.enqueue([QueueTable(job='job%d' % i) for i in range(count)])
+
+    def testDestructive(self):
+        from sqlserver_ado.tablequeue import TableQueue
+        queue = TableQueue(QueueTable)
+        jobs = self._enqueue(queue, 5)
+        taken = queue.dequeue(2)
+        self.assertEquals([obj.pk for obj in taken], [obj.pk for obj in jobs[:2]])
+        self.assertEquals(taken[0].job, u'job0')
+        self.assertEquals(QueueTable.objects.count(), 3)
+        self.assertEquals(len(queue.dequeue(10)), 3)
+        self.assertEquals(queue.dequeue(), [])
+
+    def testLease(self):
+        from sqlserver_ado.tablequeue import TableQueue
+        queue = TableQueue(QueueTable, lease_field='leased_until', ordering='-pk')
+        jobs = self._enqueue(queue, 4)
+        first = queue.dequeue(2)
+        self.assertEquals([obj.job for obj in first], [u'job3', u'job2'])
+        self.assertTrue(first[0].leased_until is not None)
+        second = queue.dequeue(5)
+        self.assertEquals([obj.job for obj in second], [u'job1', u'job0'])
+        self.assertEquals(queue.dequeue(), [])
+
+        queue.complete(first)
+        queue.release(second[:1])
+        self.assertEquals(QueueTable.objects.count(), 2)
+        self.assertEquals([obj.job for obj in queue.dequeue(5)], [u'job1'])
+
+class TableQueueCommitTestCase(TransactionTestCase):
+    def testOtherConnection(self):
+        from sqlserver_ado.tablequeue import TableQueue
+        queue = TableQueue(QueueTable)
+        queue.enqueue([QueueTable(job='job%d' % i) for i in range(3)])
+        taken = _in_thread(queue.dequeue, 2)
+        self.assertEquals([obj.job for obj in taken], [u'job0', u'job1'])
+        self.assertEquals(list(QueueTable.objects.values_list('job', flat=True)), [u'job2'])
+
+class QueryHintsTestCase(TestCase):
+    def setUp(self):
+        from sqlserver_ado.queryset import SqlServerQuerySet
+        self.qs = SqlServerQuerySet(Bug21Table).query_hints(maxdop=1, recompile=True,
+            optimize_for_unknown=True, fast=10).table_hints('NOLOCK').filter(a='x')
+        self.option = ' OPTION (MAXDOP 1, RECOMPILE, OPTIMIZE FOR UNKNOWN, FAST 10)'
+
+    def _sql(self, qs):
+        from django.db import connection
+        return qs.query.get_compiler(connection=connection).as_sql()[0]
+
+    def testSql(self):
+        sql = self._sql(self.qs)
+        self.assertTrue(sql.endswith(self.option))
+        self.assertTrue('WITH (NOLOCK)' in sql)
+        self.assertTrue(self._sql(self.qs[2:4]).endswith(self.option))
+
+    def testSubquery(self):
+        from django.db.models import Count
+        sql = self._sql(Bug21Table.objects.filter(id__in=self.qs.values('id')))
+        self.assertFalse('OPTION' in sql)
+        self.assertTrue('WITH (NOLOCK)' in sql)
+        Bug21Table.objects.create(a='x', d='1.00')
+        self.assertEquals(self.qs.annotate(n=Count('id')).count(), 1)
+
+    def testExecute(self):
+        Bug21Table.objects.create(a='x', d='1.00')
+        Bug21Table.objects.create(a='y', d='2.00')
+        self.assertEquals(self.qs.count(), 1)
+        self.assertEquals(len(self.qs[0:1]), 1)
+        self.assertTrue(self.qs.exists())
+        self.assertEquals(self.qs.table_hints('FORCESEEK').query_hints(maxdop=2).get().a, u'x')
+
+class UpdateReturningTestCase(TestCase):
+    def setUp(self):
+        from sqlserver_ado.queryset import SqlServerQuerySet
+        self.objs = [Bug27Table.objects.create(a=i) for i in range(3)]
+        self.qs = SqlServerQuerySet(Bug27Table)
+
+    def testCounter(self):
+        from django.db.models import F
+        pk = self.objs[1].pk
+        self.assertEquals(self.qs.filter(pk=pk).update_get('a', a=F('a') + 10), 11)
+        self.assertEquals(self.qs.filter(pk=pk).update_get(['pk', 'a'], a=F('a') + 1), (pk, 12))
+        self.assertEquals(self.qs.filter(pk=-1).update_get('a', a=0), None)
+        self.assertRaises(Bug27Table.MultipleObjectsReturned, self.qs.update_get, 'a', a=F('a'))
+
+    def testRows(self):
+        from django.db.models import F
+        rows = self.qs.filter(a__gte=1).update_returning(['pk', 'a'], a=F('a') * 2)
+        self.assertEquals(sorted([(row['pk'], row['a']) for row in rows]),
+            [(self.objs[1].pk, 2), (self.objs[2].pk, 4)])
+        self.assertEquals(Bug27Table.objects.get(pk=self.objs[2].pk).a, 4)
+
+    def testWhere(self):
+        # The text of the where clause also appears in the SET clause.
+        rows = self.qs.filter(a=2).update_returning(['a'], a=2)
+        self.assertEquals(rows, [{'a': 2}])
+        self.assertEquals(len(self.qs.update_returning(['pk'], a=5)), 3)
+        self.assertEquals(self.qs.filter(pk__in=[]).update_returning(['pk'], a=0), [])
+
+class TreeQueryTestCase(TestCase):
+    def setUp(self):
+        from django.db import connection
+        self.ops = connection.ops
+        root = TreeNode.objects.create(name='root')
+        a = TreeNode.objects.create(name='a', parent=root)
+        TreeNode.objects.create(name='a1', parent=a)
+        TreeNode.objects.create(name='b', parent=root)
+        self.root, self.a = root, a
+
+    def testDescendants(self):
+        nodes = self.ops.tree_query(TreeNode.objects.filter(name='root'), 'parent')
+        self.assertEquals([(n.name, n.tree_depth) for n in nodes],
+            [(u'root', 0), (u'a', 1), (u'a1', 2), (u'b', 1)])
+        self.assertEquals(nodes[2].tree_path, u'/%d/%d/%d/' % (self.root.pk, self.a.pk, nodes[2].pk))
+        self.assertEquals(nodes[2].parent_id, self.a.pk)
+
+        nodes = self.ops.tree_query(TreeNode.objects.filter(name='root'), 'parent', max_depth=1)
+        self.assertEquals([n.name for n in nodes], [u'root', u'a', u'b'])
+
+    def testAncestors(self):
+        nodes = self.ops.tree_query(TreeNode.objects.filter(name='a1'), 'parent', ancestors=True)
+        self.assertEquals([n.name for n in nodes], [u'a1', u'a', u'root'])
+
+    def testCycle(self):
+        TreeNode.objects.filter(pk=self.root.pk).update(parent=self.a)
+        nodes = self.ops.tree_query(TreeNode.objects.filter(name='root'), 'parent')
+        self.assertEquals(len(nodes), 4)
+
+class SampleTestCase(TestCase):
+    def testSql(self):
+        from django.db import connection
+        from sqlserver_ado.queryset import SqlServerQuerySet
+        qs = SqlServerQuerySet(Bug21Table).tablesample(5, seed=3).filter(a='x')[:2]
+        sql = qs.query.get_compiler(connection=connection).as_sql()[0]
+        self.assertTrue('TABLESAMPLE SYSTEM (5.0 PERCENT) REPEATABLE (3) WHERE' in sql)
+
+    def testSample(self):
+        from sqlserver_ado.queryset import SqlServerQuerySet
+        for i in range(10):
+            Bug21Table.objects.create(a=i % 2 and 'odd' or 'even', d='1.00')
+        qs = SqlServerQuerySet(Bug21Table).filter(a='odd')
+        for spread in (1, 4):
+            objs = qs.sample(3, spread=spread)
+            self.assertEquals(len(objs), 3)
+            self.assertEquals(len(set([obj.pk for obj in objs])), 3)
+            self.assertEquals(set([obj.a for obj in objs]), set([u'odd']))
+        self.assertEquals(len(qs.sample(10)), 5)
+
+class JsonTestCase(TestCase):
+    def setUp(self):
+        from sqlserver_ado.queryset import SqlServerQuerySet
+        self.qs = SqlServerQuerySet(Bug21Table).order_by('id')
+
+    def _load(self, chunks):
+        from django.utils import simplejson
+        return simplejson.loads(''.join(chunks))
+
+    def testEmpty(self):
+        self.assertEquals(self._load(self.qs.json('a')), [])
+
+    def testValues(self):
+        from django.db import connection
+        from django.db.models import Count
+        Bug21Table.objects.create(a='plain', d='1.50')
+        Bug21Table.objects.create(a='"quoted" \\ back\nslash\ttab', d='-2.00')
+        rows = self._load(self.qs.json('id', 'a', 'd', chunk_size=1))
+        self.assertEquals(rows, [dict(id=r['id'], a=r['a'], d=float(r['d'])) for r in self.qs.values('id', 'a', 'd')])
+
+        chunks = list(self.qs.extra(select={'twice': '2 * [id]'}).json('twice', encoding='utf-8'))
+        self.assertTrue(isinstance(chunks[0], str))
+        self.assertEquals([r['twice'] for r in self._load(chunks)], [2 * obj.id for obj in self.qs])
+
+        counts = self._load(connection.ops.json_chunks(self.qs.values('a').annotate(n=Count('id'))))
+        self.assertEquals(sorted([(r['a'], r['n']) for r in counts]), sorted([(obj.a, 1) for obj in self.qs]))
+
+    def testAllValues(self):
+        from django.db import connection
+        Bug21Table.objects.create(a='x', d='1.00')
+        qs = self.qs.extra(select={'b': '2', 'a2': '1'}).values()
+        rows = self._load(connection.ops.json_chunks(qs))
+        self.assertEquals(rows[0]['a2'], 1)
+        self.assertEquals(rows[0]['b'], 2)
+        self.assertEquals(rows[0]['a'], u'x')
+
+class ParallelScanTestCase(TransactionTestCase):
+    # The threads read on their own connections, which do not see the rows
+    # of an open test transaction.
+    def setUp(self):
+        from django.db import connection
+        self.ops = connection.ops
+        for i in range(50):
+            IntegerIdTable.objects.create(id=i * 3)
+
+    def testKeyBoundaries(self):
+        boundaries = self.ops.key_boundaries(IntegerIdTable, 4)
+        self.assertTrue(1 <= len(boundaries) <= 3)
+        self.assertEquals(boundaries, sorted(set(boundaries)))
+        self.assertEquals(self.ops.key_boundaries(IntegerIdTable, 1), [])
+
+    def testOrdered(self):
+        from sqlserver_ado.parallel import parallel_scan
+        rows = list(parallel_scan(IntegerIdTable.objects.all(), workers=3, ordered=True, chunk_size=4))
+        self.assertEquals([obj.id for obj in rows], range(0, 150, 3))
+
+    def testUnordered(self):
+        from sqlserver_ado.parallel import parallel_scan
+        qs = IntegerIdTable.objects.filter(id__gte=30).values_list('id', flat=True)
+        rows = list(parallel_scan(qs, workers=2, partitions=5, chunk_size=7))
+        self.assertEquals(sorted(rows), range(30, 150, 3))
+
+    def testClose(self):
+        import threading
+        from sqlserver_ado.parallel import parallel_scan
+        threads = threading.activeCount()
+        rows = parallel_scan(IntegerIdTable.objects.all(), workers=2, chunk_size=1)
+        rows.next()
+        rows.close()
+        self.assertEquals(threading.activeCount(), threads)
+        self.assertRaises(ValueError, parallel_scan, IntegerIdTable.objects.all()[:10])
@@ -2,6 +2,7 @@ from django.core.paginator import Paginator
 from django.test import TestCase
 
 from slicing.models import *
+from sqlserver_ado.paginator import CountOverPaginator, KeysetPaginator, fetch_with_count
 
 class PagingTestCase(TestCase):
     """The Paginator uses slicing internally."""
@@ -107,3 +108,69 @@ class DistinctTestCase(TestCase):
         self.assertEquals(
             [o.s for o in stuff], 
             [u'abc', u'def'])
+
+class KeysetPagingTestCase(TestCase):
+    def setUp(self):
+        for n in ['D', 'F', 'B', 'A', 'C', 'E', 'G', 'B']:
+            Products.objects.create(name=n)
+
+    def testSequentialPages(self):
+        pager = KeysetPaginator(Products.objects.all(), 3, ordering=['name'])
+        self.assertEquals(pager.ordering, ['name', 'pk'])
+        names = []
+        for i in pager.page_range:
+            names.extend([p.name for p in pager.page(i).object_list])
+        self.assertEquals(names, ['A', 'B', 'B', 'C', 'D', 'E', 'F', 'G'])
+
+    def testPageAfter(self):
+        pager = KeysetPaginator(Products.objects.all(), 3, ordering=['-name'])
+        page = pager.page_after()
+        self.assertEquals([p.name for p in page.object_list], ['G', 'F', 'E'])
+        self.assertTrue(page.has_next())
+
+        page = pager.page_after(page.next_key)
+        self.assertEquals([p.name for p in page.object_list], ['D', 'C', 'B'])
+
+        page = pager.page_after(page.next_key)
+        self.assertEquals([p.name for p in page.object_list], ['B', 'A'])
+        self.assertFalse(page.has_next())
+
+    def testPageWithKey(self):
+        pager = KeysetPaginator(Products.objects.all(), 3, ordering=['name'])
+        key = pager.page(1).next_key
+
+        # A new paginator, e.g. in the next request, seeks from the key.
+        pager = KeysetPaginator(Products.objects.all(), 3, ordering=['name'])
+        page = pager.page(2, after=key)
+        self.assertEquals([p.name for p in page.object_list], ['C', 'D', 'E'])
+
+class CountOverPagingTestCase(TestCase):
+    def setUp(self):
+        for n in ['D', 'F', 'B', 'A', 'C', 'E', 'G']:
+            Products.objects.create(name=n)
+
+    def testFetchWithCount(self):
+        qs = Products.objects.order_by('name')
+        rows, total = fetch_with_count(qs[:3])
+        self.assertEquals([p.name for p in rows], ['A', 'B', 'C'])
+        self.assertEquals(total, 7)
+
+        rows, total = fetch_with_count(qs.values_list('name', flat=True)[2:5])
+        self.assertEquals(list(rows), ['C', 'D', 'E'])
+        self.assertEquals(total, 7)
+
+        rows, total = fetch_with_count(qs.filter(name='Z')[:3])
+        self.assertEquals(rows, [])
+        self.assertEquals(total, None)
+
+    def testPages(self):
+        pager = CountOverPaginator(Products.objects.order_by('name'), 3, orphans=1)
+        page = pager.page(1)
+        self.assertEquals(pager.count, 7)
+        self.assertEquals([p.name for p in page.object_list], ['A', 'B', 'C'])
+        self.assertEquals(pager.num_pages, 2)
+
+        pager = CountOverPaginator(Products.objects.order_by('name'), 3, orphans=1)
+        page = pager.page(2)
+        self.assertEquals([p.name for p in page.object_list], ['D', 'E', 'F', 'G'])
+        self.assertFalse(page.has_next())
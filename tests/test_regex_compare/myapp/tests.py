@@ -0,0 +1,56 @@
+import re
+from django.test import TestCase
+from sqlserver_ado.regex import regex_to_like
+
+from myapp.models import Choice
+
+class RegexToLikeTestCase(TestCase):
+	def testPrefix(self):
+		self.assertEquals(regex_to_like(u'^abc'), ([u'abc%'], True, False))
+		self.assertEquals(regex_to_like(u'abc'), ([u'%abc%'], True, False))
+		self.assertEquals(regex_to_like(u'^a\\.b%'), ([u'a.b\\%%'], True, False))
+
+	def testAnchoredEnd(self):
+		self.assertEquals(regex_to_like(u'^abc$'), ([u'abc', u'abc\n'], True, False))
+		self.assertEquals(regex_to_like(u'^abc\\z'), ([u'abc'], True, False))
+
+	def testAlternation(self):
+		self.assertEquals(regex_to_like(u'^(apple|lemon) pie'), ([u'applepie%', u'lemonpie%'], True, False))
+		self.assertEquals(regex_to_like(u'colou?r'), ([u'%color%', u'%colour%'], True, False))
+
+	def testClasses(self):
+		self.assertEquals(regex_to_like(u'^b[a-c]n'), ([u'b[a-c]n%'], True, True))
+		self.assertEquals(regex_to_like(u'^[xy]'), ([u'[xy]%'], True, False))
+		self.assertEquals(regex_to_like(u'^a[^b]c'), ([u'a_c%'], False, False))
+
+	def testInexact(self):
+		self.assertEquals(regex_to_like(u'^a+b'), ([u'a%b%'], False, False))
+		self.assertEquals(regex_to_like(u'^ba.*na'), ([u'ba%na%'], True, False))
+
+	def testUntranslatable(self):
+		for pattern in (u'\\bword', u'(?=a)b', u'(a)\\1', u'a^b', u'[^a]', u'(?i)a'):
+			self.assertEquals(regex_to_like(pattern), None)
+
+
+class RegexCompareTestCase(TestCase):
+	fixtures = ['test.json']
+
+	patterns = (
+		u'^ban', u'^b[a-c]n', u'^(apple|lemon) pie', u'pie$', u'^ba.*na$', u'an+a',
+		u'^[abc]', u'^.a', u'colou?r', u'^(?:c|b)an', u'a{2}', u'^\\w+ \\w+',
+		u'\\bpie', u'^Ca',
+	)
+
+	def _expected(self, pattern, flags=0):
+		regex = re.compile(pattern, re.VERBOSE | re.DOTALL | flags)
+		return sorted([c.pk for c in Choice.objects.all() if regex.search(c.choice)])
+
+	def testRegex(self):
+		for pattern in self.patterns:
+			found = sorted(Choice.objects.filter(choice__regex=pattern).values_list('pk', flat=True))
+			self.assertEquals(found, self._expected(pattern), pattern)
+
+	def testIRegex(self):
+		for pattern in self.patterns:
+			found = sorted(Choice.objects.filter(choice__iregex=pattern).values_list('pk', flat=True))
+			self.assertEquals(found, self._expected(pattern, re.IGNORECASE), pattern)